@@ -0,0 +1,166 @@
+#!/usr/local/bin/python
+# Fill in video_info for stored files, hashing in parallel.
+#
+# Finds the files under video/ listed in data/clip.json and data/whole.json
+# that have no video_info yet, and collects their checksum and metadata in
+# a process pool, with at most --per_device reads going on per disk.
+# Results are written in batches, so an interrupted run just picks up the
+# files still missing next time.
+#
+# With --verify, files that have video_info but aren't marked stored yet
+# are hashed too; matches are marked stored, mismatches are reported.
+#
+#   python backfill_video_info.py --procs 8 --per_device 2
+import os
+import json
+import time
+import Queue
+import signal
+import collections
+import multiprocessing
+from optparse import OptionParser
+
+import ivod_db
+import util
+
+parser = OptionParser()
+parser.add_option('--procs', type=int, default=multiprocessing.cpu_count())
+parser.add_option('--per_device', type=int, default=2,
+        help='concurrent files per storage device')
+parser.add_option('--batch', type=int, default=50,
+        help='results per database transaction')
+parser.add_option('--verify', action='store_true',
+        help='also check files with video_info that are not stored yet')
+parser.add_option('--checksum_io', default='none',
+        help='read pacing per process, see util.parse_pacer')
+
+token_file = 'token.txt'
+
+def discover(db, verify):
+    """Returns [(url, fn, expected info or None, state)] to hash."""
+    download_state = dict(db.get_all_download_state())
+    video_info = dict(db.get_all_video_info())
+
+    todo = []
+    seen = set()
+    for json_fn in ('data/clip.json', 'data/whole.json'):
+        for o in json.load(file(json_fn)):
+            for bw in ('w', 'n'):
+                url = o['video_url_'+bw]
+                if url == 'n/a' or url in seen:
+                    continue
+                seen.add(url)
+                fn = util.get_store_path(o['time'], url)
+                if not os.path.exists(fn):
+                    continue
+                state = download_state.get(url)
+                info0 = video_info.get(url)
+                if info0 == 'None':
+                    info0 = None
+                if not info0:
+                    todo.append((url, fn, None, state))
+                elif verify and state != 'stored':
+                    todo.append((url, fn, info0, state))
+    todo.sort(key=lambda t: t[1])
+    return todo
+
+def init_worker(checksum_io):
+    # ^C is handled by the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    util.checksum_pacer = util.parse_pacer(checksum_io)
+
+def collect(url, fn):
+    try:
+        info = util.collect_video_info(fn)
+        return url, json.dumps(info, sort_keys=True), None
+    except Exception, e:
+        return url, None, '%s: %s' % (e.__class__.__name__, e)
+
+def write_batch(db, name, batch, stats):
+    with db.conn:
+        for url, info, info0, state in batch:
+            if info0:
+                if json.dumps(json.loads(info0), sort_keys=True) != info:
+                    print 'mismatch', url
+                    print 'info0', repr(info0)
+                    print 'info1', repr(info)
+                    stats['mismatch'] += 1
+                    continue
+                stats['verified'] += 1
+            else:
+                db.add_video_info(url, name, info)
+                stats['added'] += 1
+            if state is not None and state != 'stored':
+                db.change_job_state(url, name, 'stored')
+
+def main():
+    options, args = parser.parse_args()
+
+    with file(token_file) as f:
+        name = f.readline().strip()
+        assert name
+
+    db = ivod_db.DB()
+    todo = discover(db, options.verify)
+    total = len(todo)
+    print '%d files to hash' % total
+
+    pending = collections.OrderedDict()
+    for t in todo:
+        pending.setdefault(os.stat(t[1]).st_dev, collections.deque()).append(t)
+    inflight = collections.defaultdict(int)
+    jobs = {}
+    results = Queue.Queue()
+
+    pool = multiprocessing.Pool(options.procs, init_worker,
+            (options.checksum_io,))
+    stats = collections.Counter()
+    batch = []
+    t0 = time.time()
+    try:
+        while pending or jobs:
+            for dev in pending.keys():
+                queue = pending[dev]
+                while queue and inflight[dev] < options.per_device and \
+                        len(jobs) < options.procs:
+                    t = queue.popleft()
+                    jobs[t[0]] = t, dev
+                    inflight[dev] += 1
+                    pool.apply_async(collect, t[:2], callback=results.put)
+                if not queue:
+                    del pending[dev]
+
+            # a timeout keeps the wait interruptible
+            while True:
+                try:
+                    url, info, error = results.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    pass
+            (url, fn, info0, state), dev = jobs.pop(url)
+            inflight[dev] -= 1
+            if error:
+                print 'error', fn, error
+                stats['error'] += 1
+                continue
+            batch.append((url, info, info0, state))
+            if len(batch) >= options.batch:
+                write_batch(db, name, batch, stats)
+                batch = []
+                done = sum(stats.values())
+                print '%d/%d files, %.1f files/s' % (done, total,
+                        done / (time.time() - t0))
+    except KeyboardInterrupt:
+        print 'interrupted, saving finished files'
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+    if batch:
+        write_batch(db, name, batch, stats)
+    db.close()
+
+    print 'added %(added)d, verified %(verified)d, mismatch %(mismatch)d, errors %(error)d' % stats
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/local/bin/python
+# Throughput of util.calc_checksum under each read pacing mode.
+#
+# Writes a synthetic tree of --files random files of --size MB under --dir,
+# then hashes the whole tree once per mode, evicting it from the page cache
+# before each run where posix_fadvise is available.
+#
+#   python bench_checksum.py --files 8 --size 256
+#   python bench_checksum.py fixed none mbps=40 latency=0.02
+import os
+import time
+from optparse import OptionParser
+
+import util
+
+parser = OptionParser(usage='%prog [options] [mode...]')
+parser.add_option('--dir', default=os.path.join('tmp', 'bench_checksum'))
+parser.add_option('--files', type=int, default=4)
+parser.add_option('--size', type=int, default=64, help='MB per file')
+
+MODES = ['fixed', 'none', 'mbps=40', 'mbps=40,iops=80', 'iops=200',
+        'latency=0.05']
+
+def make_tree(options):
+    paths = []
+    for i in range(options.files):
+        dn = os.path.join(options.dir, '%02d' % (i % 4))
+        if not os.path.exists(dn):
+            os.makedirs(dn)
+        path = os.path.join(dn, '%d.wmv' % i)
+        paths.append(path)
+        if os.path.exists(path) and os.path.getsize(path) == options.size * 2**20:
+            continue
+        with file(path, 'wb') as f:
+            for j in range(options.size):
+                f.write(os.urandom(2**20))
+    return paths
+
+def drop_cache(paths):
+    for path in paths:
+        with file(path, 'rb') as f:
+            util.fadvise(f, util.POSIX_FADV_DONTNEED)
+
+def main():
+    options, modes = parser.parse_args()
+    paths = make_tree(options)
+    total = sum(os.path.getsize(path) for path in paths)
+    if not util._fadvise:
+        print 'no posix_fadvise, later runs may read from the page cache'
+
+    expect = None
+    for mode in modes or MODES:
+        pacer = util.parse_pacer(mode)
+        drop_cache(paths)
+        t0 = time.time()
+        digests = [util.calc_checksum(path, pacer) for path in paths]
+        elapsed = time.time() - t0
+        if expect is None:
+            expect = digests
+        assert digests == expect, 'checksum differs in mode %s' % mode
+        print '%-20s %8.1f MB/s  %6.2f s  block %d' % (mode,
+                total / 2.**20 / elapsed, elapsed, pacer.block_size)
+
+if __name__ == '__main__':
+    main()
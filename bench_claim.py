@@ -0,0 +1,125 @@
+#!/usr/local/bin/python
+# Load benchmark for job claiming.
+#
+# Runs N simulated download clients against a scratch PostgreSQL database
+# and reports claims/sec and latency percentiles.  The database given by
+# --dsn is wiped and recreated from ivod.schema.
+#
+#   createdb ivod_bench
+#   python bench_claim.py --dsn 'dbname=ivod_bench' -c 32 -j 20000
+import sys
+import time
+import threading
+import datetime
+from optparse import OptionParser
+
+import ivod_db
+
+parser = OptionParser()
+parser.add_option('--dsn', default='dbname=ivod_bench')
+parser.add_option('-c', '--clients', type=int, default=16)
+parser.add_option('-j', '--jobs', type=int, default=10000)
+parser.add_option('--bw', default='high')
+parser.add_option('--legacy', action='store_true',
+        help='use the old SELECT ... LIMIT 1 FOR UPDATE claim')
+
+# the /next predicate before eligible_at existed
+LEGACY_ELIGIBLE_COND = '''(
+    (state = 'no')
+    OR (state = 'downloading' AND clip = 1 AND last_modified < now() - interval '12 hours')
+    OR (state = 'downloading' AND clip = 0 AND last_modified < now() - interval '24 hours')
+    OR (state = 'failed' AND last_modified < now() - interval '10 minutes')
+    OR (state = '404' AND last_modified < now() - interval '10 minutes')
+    )'''
+
+def create_schema(db):
+    with db.conn:
+        for table in ('metadata_per_date', 'metadata', 'download_state_history',
+                'download_state', 'download_status_summary',
+                'download_status_delta', 'upload_state',
+                'users', 'video_info'):
+            db.modify('DROP TABLE IF EXISTS %s CASCADE' % table)
+        db.modify(file('ivod.schema').read())
+
+def setup(dsn, num_jobs):
+    db = ivod_db.DB(dsn)
+    create_schema(db)
+    day = datetime.date(2012, 1, 1)
+    with db.conn:
+        c = db.conn.cursor()
+        c.executemany('''
+        INSERT INTO download_state(key, username, state, bw, clip, videodate)
+        VALUES (%s, 'bench', 'no', %s, %s, %s)''',
+            [('mms://bench/%d' % i, i % 2, i / 2 % 2,
+                day + datetime.timedelta(days=i % 1000))
+                for i in range(num_jobs)])
+        c.close()
+    db.rebuild_status_summary()
+    db.close()
+
+def legacy_claim(db, name, bw):
+    while True:
+        with db.conn:
+            rows = db.query('''
+            SELECT key, videodate, state
+            FROM download_state
+            WHERE %s AND state != '404skip' AND %s
+            ORDER BY last_modified
+            LIMIT 1
+            FOR UPDATE
+            ''' % (LEGACY_ELIGIBLE_COND, ivod_db.BW_COND.get(bw, 'true')))
+            if not rows:
+                return []
+            key, videodate, state = rows[0]
+            db.change_job_state(key, name, 'downloading')
+            return [(key, videodate)]
+
+def client(options, idx, latencies, claimed):
+    db = ivod_db.DB(options.dsn)
+    name = 'client%d' % idx
+    while True:
+        t0 = time.time()
+        if options.legacy:
+            jobs = legacy_claim(db, name, options.bw)
+        else:
+            jobs = db.claim_jobs(name, options.bw)
+        latencies.append(time.time() - t0)
+        if not jobs:
+            break
+        claimed.extend(job[0] for job in jobs)
+    db.close()
+
+def percentile(data, p):
+    data = sorted(data)
+    if not data:
+        return 0
+    return data[min(len(data) - 1, int(len(data) * p))]
+
+def main():
+    options, args = parser.parse_args()
+
+    print 'setup %d jobs' % options.jobs
+    setup(options.dsn, options.jobs)
+
+    latencies = []
+    claimed = []
+    threads = [threading.Thread(target=client,
+        args=(options, i, latencies, claimed))
+        for i in range(options.clients)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+
+    assert len(claimed) == len(set(claimed)), 'job handed out twice'
+    print 'clients     %d' % options.clients
+    print 'claims      %d' % len(claimed)
+    print 'claims/sec  %.1f' % (len(claimed) / elapsed)
+    print 'p50         %.2f ms' % (percentile(latencies, 0.50) * 1000)
+    print 'p99         %.2f ms' % (percentile(latencies, 0.99) * 1000)
+    print 'max         %.2f ms' % (max(latencies) * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/local/bin/python
+# Compare the /next lookup on eligible_at with the old time-predicate scan.
+#
+# Fills a scratch database (wiped, see bench_claim.py) with --rows jobs in a
+# mix of states resembling the production archive and times the single-row
+# lookup of each bandwidth class with both queries.
+#
+#   python bench_eligible.py --dsn 'dbname=ivod_bench' --rows 1000000
+import time
+from optparse import OptionParser
+
+import ivod_db
+from bench_claim import create_schema, percentile, LEGACY_ELIGIBLE_COND
+
+parser = OptionParser()
+parser.add_option('--dsn', default='dbname=ivod_bench')
+parser.add_option('--rows', type=int, default=1000000)
+parser.add_option('-n', '--repeat', type=int, default=200)
+
+LEGACY_SQL = '''
+SELECT key FROM download_state
+WHERE %s AND state != '404skip' AND %s
+ORDER BY last_modified
+LIMIT 1
+FOR UPDATE'''
+
+ELIGIBLE_SQL = '''
+SELECT key FROM download_state
+WHERE %s AND %s
+ORDER BY eligible_at
+LIMIT 1
+FOR UPDATE SKIP LOCKED'''
+
+def setup(db, rows):
+    create_schema(db)
+    with db.conn:
+        # mostly finished jobs, a few percent waiting or retrying
+        db.modify('''
+        INSERT INTO download_state(key, username, state, bw, clip, videodate, last_modified)
+        SELECT 'mms://bench/' || i, 'bench',
+            CASE
+                WHEN r < 0.90 THEN 'stored'
+                WHEN r < 0.93 THEN 'downloaded'
+                WHEN r < 0.95 THEN 'no'
+                WHEN r < 0.97 THEN 'failed'
+                WHEN r < 0.98 THEN '404'
+                WHEN r < 0.99 THEN 'downloading'
+                ELSE '404skip'
+            END,
+            i %% 2, i / 2 %% 2,
+            date '2012-01-01' + i %% 1000,
+            now() - random() * interval '2 days'
+        FROM (SELECT i, random() AS r FROM generate_series(1, %s) i) s''',
+            rows)
+        db.modify('UPDATE download_state SET eligible_at = %s'
+                % ivod_db.ELIGIBLE_AT % dict(state='state', ts='last_modified'))
+    db.conn.autocommit = True
+    db.modify('VACUUM ANALYZE download_state')
+    db.conn.autocommit = False
+
+def run(db, sql, repeat):
+    print db.query('EXPLAIN ' + sql)[0][0]
+    times = []
+    for i in range(repeat):
+        t0 = time.time()
+        db.query(sql)
+        times.append(time.time() - t0)
+        db.conn.rollback()
+    return sum(times) / len(times), percentile(times, 0.99)
+
+def main():
+    options, args = parser.parse_args()
+    db = ivod_db.DB(options.dsn)
+    print 'setup %d rows' % options.rows
+    setup(db, options.rows)
+
+    for bw in ('high', 'mid', 'low'):
+        cond = ivod_db.BW_COND[bw]
+        for name, sql in (
+                ('legacy', LEGACY_SQL % (LEGACY_ELIGIBLE_COND, cond)),
+                ('eligible_at', ELIGIBLE_SQL % (ivod_db.ELIGIBLE_COND, cond))):
+            avg, p99 = run(db, sql, options.repeat)
+            print '%-4s %-12s avg %8.3f ms  p99 %8.3f ms' % (
+                    bw, name, avg * 1000, p99 * 1000)
+    db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/local/bin/python
+# Side-by-side load test of server.py deployments.
+#
+# Start the servers on a scratch database (see bench_claim.py), e.g.
+#   python server.py                 # CherryPy, port 8080
+#   python server.py --gevent --port 8081
+# then
+#   python bench_server.py --idle 2000 http://192.168.0.254:8080/ http://192.168.0.254:8081/
+#
+# For each server it opens --idle connections that send nothing, then runs
+# --clients simulated download clients doing next/change round trips, and
+# reports requests/sec and latency while the idle connections are held.
+import json
+import time
+import socket
+import random
+import urllib
+import urllib2
+import urlparse
+import threading
+from optparse import OptionParser
+
+from bench_claim import percentile
+
+parser = OptionParser(usage='%prog [options] url...')
+parser.add_option('-c', '--clients', type=int, default=50)
+parser.add_option('-d', '--duration', type=float, default=30)
+parser.add_option('--idle', type=int, default=0,
+        help='idle connections held open during the run')
+parser.add_option('--bw', default='high')
+
+def request(base, path, **argd):
+    t0 = time.time()
+    r = urllib2.urlopen(base + path, urllib.urlencode(argd), timeout=60)
+    data = r.read()
+    return data, time.time() - t0
+
+def register(base):
+    name = 'bench%d' % random.getrandbits(32)
+    data, t = request(base, 'register', name=name, contact=name)
+    return name, json.loads(data)['token']
+
+def open_idle(base, n):
+    u = urlparse.urlparse(base)
+    socks = []
+    for i in range(n):
+        s = socket.create_connection((u.hostname, u.port or 80), timeout=10)
+        socks.append(s)
+    return socks
+
+def client(base, name, token, bw, deadline, latencies, errors):
+    while time.time() < deadline:
+        try:
+            job, t = request(base, 'next', name=name, token=token, bw=bw)
+            latencies.append(t)
+            if job in ('done', 'wait'):
+                continue
+            result, t = request(base, 'change', name=name, token=token,
+                    key=job, state='failed')
+            latencies.append(t)
+        except Exception:
+            errors.append(1)
+
+def bench(base, options):
+    name, token = register(base)
+    socks = open_idle(base, options.idle)
+
+    latencies = []
+    errors = []
+    deadline = time.time() + options.duration
+    threads = [threading.Thread(target=client,
+        args=(base, name, token, options.bw, deadline, latencies, errors))
+        for i in range(options.clients)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - t0
+
+    for s in socks:
+        s.close()
+
+    print base
+    print '  idle connections  %d' % options.idle
+    print '  requests          %d' % len(latencies)
+    print '  errors            %d' % len(errors)
+    print '  requests/sec      %.1f' % (len(latencies) / elapsed)
+    print '  p50               %.2f ms' % (percentile(latencies, 0.50) * 1000)
+    print '  p99               %.2f ms' % (percentile(latencies, 0.99) * 1000)
+
+def main():
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no server url given')
+    for base in args:
+        if not base.endswith('/'):
+            base += '/'
+        bench(base, options)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+#!/usr/local/bin/python
+# Microbenchmark of ASF header parsing with each videoparser stream backend.
+#
+# Writes --files synthetic ASF files shaped like the IVOD recordings (one
+# audio and one video stream, header extension, codec list, bitrate
+# properties, a few data packets) under --dir, then parses all headers with
+# the file-reading BinaryStream and with the mmap-backed BufferStream.
+#
+#   python bench_videoparser.py --files 5000
+#
+# With --check_guids it instead compares read_guid against the original
+# field by field decoding, for every object guid in the corpus and for
+# random guids in both byte orders.
+#
+# With --metadata it times wmv.extract_metadata, which parses only the
+# header objects it needs, against a full VideoParser pass, and checks both
+# give the same metadata.
+#
+# With --memory it keeps the parsed ASF header objects of the whole corpus
+# alive and reports how much the process grew per header.
+import gc
+import os
+import time
+import uuid
+import struct
+import random
+import resource
+from optparse import OptionParser
+
+import wmv
+import videoparser
+import videoparser.videofile
+import videoparser.plugins.asf
+import videoparser.streams.binary
+import videoparser.streams.endian
+import videoparser.streams.factory
+
+parser = OptionParser()
+parser.add_option('--dir', default=os.path.join('tmp', 'bench_videoparser'))
+parser.add_option('--files', type=int, default=2000)
+parser.add_option('--rounds', type=int, default=3)
+parser.add_option('--check_guids', action='store_true')
+parser.add_option('--metadata', action='store_true')
+parser.add_option('--memory', action='store_true')
+
+def guid(s):
+    return uuid.UUID(s).bytes_le
+
+def asf_object(s, body):
+    return guid(s) + struct.pack('<Q', 24 + len(body)) + body
+
+def wchars(s):
+    return (s + u'\0').encode('utf-16-le')
+
+def make_asf(seed=0, packets=20, packet_size=3200):
+    """A small but complete ASF file."""
+    rnd = random.Random(seed)
+    duration = rnd.randint(60, 4 * 3600)
+    file_id = guid(str(uuid.UUID(int=rnd.getrandbits(128))))
+    file_properties = asf_object('8CABDCA1-A947-11CF-8EE4-00C00C205365',
+            file_id + struct.pack('<QQQQQQIIII', 0,
+                128000000000000000 + rnd.getrandbits(48), packets,
+                duration * 10000000 + 30000000, duration * 10000000, 3000, 2,
+                packet_size, packet_size, 400000))
+
+    wfx = struct.pack('<HHIIHHH', 0x161, 2, 44100, 8000, 2, 16, 10) + '\0' * 10
+    audio = asf_object('B7DC0791-A9B7-11CF-8EE6-00C00C205365',
+            guid('F8699E40-5B4D-11CF-A8FD-00805F5C442B') +
+            guid('BFC3CD50-618F-11CF-8BB2-00AA00B4E220') +
+            struct.pack('<QIIH', 0, len(wfx), 8, 1) + '\0' * 4 + wfx + '\1' * 8)
+    bih = struct.pack('<IIIHH4sIIIII', 40, 320, 240, 0, 24, 'WMV3', 0, 0, 0, 0, 0)
+    vinfo = struct.pack('<IIBH', 320, 240, 2, len(bih)) + bih
+    video = asf_object('B7DC0791-A9B7-11CF-8EE6-00C00C205365',
+            guid('BC19EFC0-5B4D-11CF-A8FD-00805F5C442B') +
+            guid('20FB5700-5B55-11CF-A8FD-00805F5C442B') +
+            struct.pack('<QIIH', 0, len(vinfo), 0, 2) + '\0' * 4 + vinfo)
+
+    def extended_stream_properties(number, bitrate, time_per_frame):
+        return asf_object('14E6A5CB-C672-4332-8399-A96952065B5A',
+                struct.pack('<QQIIIIIIIIHHQHH', 0, 0, bitrate, 3000, 3000,
+                    bitrate, 3000, 3000, 0, 2, number, 0, time_per_frame, 0, 0))
+    extension = extended_stream_properties(1, 64000, 0) + \
+            extended_stream_properties(2, 300000, 333333) + \
+            asf_object('1806D474-CADF-4509-A4BA-9AABCB96AAE8', '\0' * 16)
+    header_extension = asf_object('5FBF03B5-A92E-11CF-8EE3-00C00C205365',
+            guid('ABD3D211-A9BA-11CF-8EE6-00C00C205365') +
+            struct.pack('<HI', 6, len(extension)) + extension)
+
+    codec = struct.pack('<HH', 2, 5) + wchars(u'WMV9') + \
+            struct.pack('<H', 1) + wchars(u'') + struct.pack('<H', 4) + 'WMV3'
+    codec_list = asf_object('86D15240-311D-11D0-A3A4-00A0C90348F6',
+            guid('86D15241-311D-11D0-A3A4-00A0C90348F6') +
+            struct.pack('<I', 1) + codec)
+    bitrates = asf_object('7BF875CE-468D-11D1-8D82-006097C9A2B2',
+            struct.pack('<HHIHI', 2, 1, 64000, 2, 300000))
+
+    objects = [file_properties, audio, video, header_extension, codec_list,
+            bitrates]
+    body = struct.pack('<IBB', len(objects), 1, 2) + ''.join(objects)
+    header = guid('75B22630-668E-11CF-A6D9-00AA0062CE6C') + \
+            struct.pack('<Q', 24 + len(body)) + body
+    data = guid('75B22636-668E-11CF-A6D9-00AA0062CE6C') + \
+            struct.pack('<Q', 50 + packets * packet_size) + file_id + \
+            struct.pack('<QH', packets, 0x101)
+    payload = ''.join(chr(0x82) + '\0' * (packet_size - 1)
+            for i in range(packets))
+    return header + data + payload
+
+def make_corpus(dn, n):
+    if not os.path.exists(dn):
+        os.makedirs(dn)
+    paths = []
+    for i in range(n):
+        path = os.path.join(dn, '%05d.wmv' % i)
+        if not os.path.exists(path):
+            with file(path, 'wb') as f:
+                f.write(make_asf(seed=i))
+        paths.append(path)
+    return paths
+
+def legacy_guid(data, endianess):
+    """read_guid as it was before guids were decoded in one unpack."""
+    e = '>' if endianess == videoparser.streams.endian.big else '<'
+    time_low, = struct.unpack(e + 'I', data[0:4])
+    time_mid, = struct.unpack(e + 'H', data[4:6])
+    time_hi, = struct.unpack(e + 'H', data[6:8])
+    clock_seq_hi = ord(data[8])
+    clock_seq_low = ord(data[9])
+    node = 0
+    for octet in data[10:16]:
+        node = (node << 8) + ord(octet)
+    return "%08X-%04X-%04X-%X%X-%012X" % (time_low, time_mid, time_hi,
+            clock_seq_hi, clock_seq_low, node)
+
+def header_guids(data):
+    """Object guids of the header object and of the objects in it."""
+    guids = [data[0:16]]
+    count, = struct.unpack_from('<I', data, 24)
+    pos = 30
+    for i in range(count):
+        guids.append(data[pos:pos+16])
+        size, = struct.unpack_from('<Q', data, pos + 16)
+        pos += size
+    return guids
+
+def check_guids(paths, n=100000):
+    binary = videoparser.streams.binary
+    samples = []
+    for path in paths:
+        samples.extend(header_guids(file(path, 'rb').read(65536)))
+    rnd = random.Random(0)
+    samples.extend(''.join(chr(rnd.getrandbits(8)) for j in range(16))
+            for i in range(n))
+    for endianess in (videoparser.streams.endian.little,
+            videoparser.streams.endian.big):
+        table = binary.guid_table(videoparser.plugins.asf.guid_list, endianess)
+        for data in samples:
+            expect = legacy_guid(data, endianess)
+            stream = videoparser.streams.factory.create_stringstream(data,
+                    endianess)
+            assert stream.read_guid() == expect, (data, expect)
+            assert table.get(data) == \
+                    videoparser.plugins.asf.guid_list.get(expect), expect
+    print '%d guids match' % (2 * len(samples))
+
+def parse_all(paths):
+    asf = videoparser.plugins.asf.Parser()
+    for path in paths:
+        video = videoparser.videofile.VideoFile()
+        assert asf.parse(path, video)
+
+def full_metadata(paths):
+    result = []
+    for path in paths:
+        video = videoparser.parse_file(path)
+        result.append(wmv.header_metadata(video.header))
+    return result
+
+def header_metadata(paths):
+    return [wmv.extract_metadata(path) for path in paths]
+
+def bench(name, func, paths, rounds):
+    best = None
+    for i in range(rounds):
+        t0 = time.time()
+        result = func(paths)
+        elapsed = time.time() - t0
+        best = min(best, elapsed) if best is not None else elapsed
+    print '%-16s %8.1f headers/s  %7.1f us/header' % (name,
+            len(paths) / best, best / len(paths) * 1e6)
+    return result
+
+def rss():
+    """Peak resident size of the process in bytes."""
+    # ru_maxrss is in kilobytes on Linux, bytes on OS X
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if os.uname()[0] == 'Darwin' else maxrss * 1024
+
+def measure_memory(paths):
+    asf = videoparser.plugins.asf.Parser()
+    gc.collect()
+    rss0 = rss()
+    kept = []
+    for path in paths:
+        stream = videoparser.streams.factory.create_filestream(path,
+                asf._endianess)
+        stream.read_guid_bytes()
+        kept.append(asf.parse_header(stream))
+        stream.close()
+    gc.collect()
+    grown = rss() - rss0
+    print '%d headers kept, %.1f MB, %d bytes/header' % (len(kept),
+            grown / 2.**20, grown / len(kept))
+
+def main():
+    options, args = parser.parse_args()
+    paths = make_corpus(options.dir, options.files)
+    if options.check_guids:
+        check_guids(paths)
+        return
+
+    if options.memory:
+        measure_memory(paths)
+        return
+
+    if options.metadata:
+        full = bench('VideoParser', full_metadata, paths, options.rounds)
+        lazy = bench('extract_metadata', header_metadata, paths,
+                options.rounds)
+        assert full == lazy, 'metadata differs'
+        return
+
+    for name, use_mmap in (('BinaryStream', False), ('BufferStream', True)):
+        videoparser.streams.factory.use_mmap = use_mmap
+        bench(name, parse_all, paths, options.rounds)
+
+if __name__ == '__main__':
+    main()
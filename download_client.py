@@ -6,32 +6,198 @@ import time
 import sys
 import os
 import urllib
-import urllib2
+import urlparse
+import httplib
+import socket
+import select
+import uuid
 import traceback
 import hashlib
 import datetime
 import random
+import threading
+import Queue
+import collections
+import signal
 from optparse import OptionParser
 
 import util
+import mmsh
 
 parser = OptionParser()
 parser.add_option('-v', '--verbose', action='store_true')
 parser.add_option('--msdl_bin', type=str)
+parser.add_option('--parallel', type=int, default=1,
+        help='number of concurrent transfers')
+parser.add_option('--downloader', choices=['msdl', 'mmsh'], default='msdl',
+        help='msdl subprocess or the built-in MMSH downloader')
+parser.add_option('--rate', type=float,
+        help='target aggregate download rate in KB/s')
+parser.add_option('--race', type=int, default=0, metavar='SECONDS',
+        help='download whole sessions from two mirrors for the first '
+        'SECONDS and keep the faster one (mmsh only)')
 
 msdl_bin = './msdl'
 
-g_alt_server = False
 jm = None
+governor = None
 
 program_start_time = time.time()
 
+# seconds to let the server hold /next until a job shows up
+LONG_POLL = 120
+
+# partial mmsh transfers kept for resuming, and how long they are kept
+PARTIAL_DIR = os.path.join('tmp', 'partial')
+PARTIAL_MAX_AGE = 3 * 86400
+# immediate retries of a transfer that broke off after making progress
+MMSH_RETRY = 3
+
+# hosts serving the same videos
+MIRRORS = ['mediavod01', 'mediavod02']
+
+# backoff between attempts of a request before jitter; requests are retried
+# until the server is back, however long that takes
+REQUEST_RETRY = 5
+REQUEST_RETRY_MAX = 60 * 10
+# socket timeout, on top of the wait of long-polls
+REQUEST_TIMEOUT = 60
+
+class Rejected(Exception):
+    """The server refused the request itself (HTTP 4xx); sending it again
+    won't help."""
+
+class CircuitBreaker:
+    """Stops hammering an endpoint that keeps failing.  After threshold
+    failures in a row it opens for cooldown seconds, then lets one trial
+    request through while the others keep waiting; each failed trial
+    doubles the cooldown up to max_cooldown.  Shared by threads."""
+    # how often callers waiting on a trial request look again
+    probe_poll = 5
+
+    def __init__(self, threshold=3, cooldown=60, max_cooldown=60*10):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.opened = 0
+        self.open_for = cooldown
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def wait_time(self):
+        """Seconds to hold off before sending; 0 lets the request through,
+        and makes it the trial request when half-open."""
+        with self.lock:
+            if self.failures < self.threshold:
+                return 0
+            left = self.opened + self.open_for - time.time()
+            if left > 0:
+                return left
+            if self.probing:
+                return self.probe_poll
+            self.probing = True
+            return 0
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.open_for = self.cooldown
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures > self.threshold:
+                self.open_for = min(self.open_for * 2, self.max_cooldown)
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+            self.probing = False
+
+    def state(self):
+        with self.lock:
+            if self.failures < self.threshold:
+                return 'closed'
+            if self.opened + self.open_for > time.time():
+                return 'open'
+            return 'half-open'
+
+class MirrorSelector:
+    """Routes each job to the mirror doing best lately.
+
+    Keeps the outcome and throughput of the last window transfers from each
+    mirror, forgetting those older than max_age, and ranks mirrors by
+    success rate times median throughput, then by fewer 404s.  A mirror with
+    fewer than min_samples recent transfers ranks first, so every mirror is
+    tried again now and then.
+    """
+    def __init__(self, mirrors, window=20, max_age=3600, min_samples=2):
+        self.mirrors = mirrors
+        self.max_age = max_age
+        self.min_samples = min_samples
+        self.history = dict((m, collections.deque(maxlen=window)) for m in mirrors)
+        self.lock = threading.Lock()
+
+    def mirror_of(self, url):
+        for m in self.mirrors:
+            if m in url:
+                return m
+        return None
+
+    def url_for(self, url, mirror):
+        m = self.mirror_of(url)
+        if not m or not mirror:
+            return url
+        return url.replace(m, mirror)
+
+    def record(self, mirror, state, rate):
+        if mirror not in self.history:
+            return
+        with self.lock:
+            self.history[mirror].append((time.time(), state, rate or 0))
+
+    def stats(self):
+        d = {}
+        with self.lock:
+            for m in self.mirrors:
+                h = self.history[m]
+                while h and h[0][0] < time.time() - self.max_age:
+                    h.popleft()
+                n = len(h)
+                rates = sorted(rate for t, state, rate in h if state == 'downloaded')
+                d[m] = dict(samples=n,
+                        success=len(rates) / float(n) if n else 0,
+                        not_found=sum(1 for t, state, rate in h if state == '404') / float(n) if n else 0,
+                        rate=rates[len(rates) / 2] if rates else 0)
+        return d
+
+    def ranked(self):
+        stats = self.stats()
+        def key(m):
+            s = stats[m]
+            if s['samples'] < self.min_samples:
+                return (1, -s['samples'], 0)
+            return (0, s['success'] * s['rate'], -s['not_found'])
+        return sorted(self.mirrors, key=key, reverse=True)
+
+selector = MirrorSelector(MIRRORS)
+
 class JobManager:
     def __init__(self):
         self.host = 'http://ivod.kcwu.csie.org/'
         self.name = ''
         self.token = ''
         self.token_file = 'token.txt'
+        # results not yet acknowledged by the server, one JSON list per line
+        self.journal_file = 'journal.txt'
+        self.next_job = None
+        # seconds the last /next request took, to tell long-polls apart
+        self.last_poll = 0
+        self.reporter = None
+        # a keep-alive connection per thread
+        self.local = threading.local()
+        self.breakers = collections.defaultdict(CircuitBreaker)
+        self.counters = collections.defaultdict(collections.Counter)
 
     def load_token(self):
         if not os.path.exists(self.token_file):
@@ -43,41 +209,287 @@ class JobManager:
         return True
 
     def _request(self, path, **argd):
-        for i in range(5):
-            if self.name and self.token:
-                d = dict(name=self.name, token=self.token)
-            else:
-                d = {}
-            d.update(argd)
-            data = urllib.urlencode(d)
+        """POST to path.  Failures are retried with exponential backoff and
+        full jitter until the server answers, and an endpoint failing
+        repeatedly is left alone for a while.  Returns None if the server
+        rejected the request."""
+        if self.name and self.token:
+            d = dict(name=self.name, token=self.token)
+        else:
+            d = {}
+        d.update(argd)
+        data = urllib.urlencode(d)
+        timeout = REQUEST_TIMEOUT + int(argd.get('wait', 0))
+        breaker = self.breakers[path]
+        counters = self.counters[path]
+        i = 0
+        while True:
+            wait = breaker.wait_time()
+            if wait:
+                print '%s keeps failing, wait %d seconds' % (path, wait)
+                while wait:
+                    time.sleep(wait)
+                    wait = breaker.wait_time()
+            if i:
+                counters['retries'] += 1
+            counters['requests'] += 1
+            t0 = time.time()
             try:
-                url = self.host + path
-                r = urllib2.urlopen(url, data)
+                result = self._post(path, data, timeout)
+            except Rejected, e:
+                # the server is fine, it's the request
+                breaker.success()
+                counters['rejected'] += 1
+                print '%s rejected: %s' % (path, e)
+                print 'data:', data
+                return None
             except Exception:
+                counters['failures'] += 1
+                breaker.failure()
                 traceback.print_exc()
-                print 'url:', url
+                print 'url:', self.host + path
                 print 'data:', data
-                print 'sleep...'
-                time.sleep(60*10)
-                print 'retry'
+                delay = random.uniform(0,
+                        min(REQUEST_RETRY_MAX, REQUEST_RETRY * 2 ** min(i, 16)))
+                print 'retry in %d seconds' % delay
+                time.sleep(delay)
+                i += 1
                 continue
 
-            result = r.read()
+            latency = time.time() - t0
+            counters['latency'] += latency
+            counters['max_latency'] = max(counters['max_latency'], latency)
+            breaker.success()
             #print result
             return result
 
-    def get(self, bw=None):
-        return self._request('next', bw=bw)
+    def _post(self, path, data, timeout):
+        u = urlparse.urlsplit(self.host)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        # a reused connection may have been closed by the server meanwhile.
+        # Only a request that couldn't be sent at all is tried again on a
+        # fresh connection: once sent, /next may have leased a job already,
+        # and a second one would lease another.
+        for fresh in (False, True):
+            conn = getattr(self.local, 'conn', None)
+            if conn is not None and conn.sock and \
+                    select.select([conn.sock], [], [], 0)[0]:
+                # an idle keep-alive socket turning readable was closed
+                conn.close()
+                conn = None
+            if conn is None:
+                fresh = True
+                conn = self.local.conn = httplib.HTTPConnection(
+                        u.hostname, u.port or 80, timeout=timeout)
+            elif conn.sock:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request('POST', u.path + path, data, headers)
+            except socket.error:
+                conn.close()
+                self.local.conn = None
+                if fresh:
+                    raise
+                continue
+            except Exception:
+                conn.close()
+                self.local.conn = None
+                raise
+            try:
+                r = conn.getresponse()
+                result = r.read()
+            except Exception:
+                conn.close()
+                self.local.conn = None
+                raise
+            break
+        if 400 <= r.status < 500:
+            raise Rejected('HTTP %d %s' % (r.status, r.reason))
+        if r.status != 200:
+            raise httplib.HTTPException('HTTP %d %s' % (r.status, r.reason))
+        return result
+
+    def stats(self):
+        """Request counters and circuit state per endpoint."""
+        d = {}
+        for path, counters in self.counters.items():
+            d[path] = dict(counters)
+            if counters['requests'] > counters['failures']:
+                d[path]['avg_latency'] = counters['latency'] / (
+                        counters['requests'] - counters['failures'])
+            d[path]['circuit'] = self.breakers[path].state()
+        return d
+
+    def get(self, bw=None, wait=0):
+        """With wait, the server holds the request up to wait seconds until a
+        job is available before answering 'done' or 'wait'.  Returns the
+        prefetched job instead if there is one."""
+        if self.next_job is not None:
+            q, self.next_job = self.next_job, None
+            job = q.get()
+            # 'done' or 'wait' may be stale by now, ask again
+            if job and job not in ('done', 'wait'):
+                return job
+        return self._get(bw, wait)
 
-    def change_state(self, job, state, info):
+    def _get(self, bw, wait):
+        t0 = time.time()
+        # sent again with every retry, so a lost answer doesn't lease twice
+        claim = uuid.uuid4().hex
+        try:
+            if wait:
+                return self._request('next', bw=bw, wait=wait, claim=claim)
+            return self._request('next', bw=bw, claim=claim)
+        finally:
+            self.last_poll = time.time() - t0
+
+    def prefetch(self, bw=None, wait=0):
+        """Ask for the next job in the background, e.g. while the current one
+        downloads.  The next get() returns it."""
+        if self.next_job is not None:
+            return
+        q = self.next_job = Queue.Queue()
+        t = threading.Thread(target=lambda: q.put(self._get(bw, wait)))
+        t.daemon = True
+        t.start()
+
+    def release_prefetched(self):
+        """Give a prefetched job back unattempted, so it is handed out again
+        right away rather than when its lease runs out."""
+        if self.next_job is None:
+            return
+        q, self.next_job = self.next_job, None
+        job = q.get()
+        if job and job not in ('done', 'wait'):
+            self.report(job, 'released', None)
+
+    def get_batch(self, bw=None, n=1, wait=0):
+        """Lease up to n jobs in one request.  Returns a list of jobs in the
+        same form as get(), or 'done'/'wait'/None like get()."""
+        claim = uuid.uuid4().hex
+        if wait:
+            result = self._request('next_batch', bw=bw, n=n, wait=wait,
+                    claim=claim)
+        else:
+            result = self._request('next_batch', bw=bw, n=n, claim=claim)
+        if not result or result in ('done', 'wait'):
+            return result
+        return [json.dumps((t, url)) for t, url, lease in json.loads(result)]
+
+    def change_state(self, job, state, info, rate=None):
         #print 'change_state', job, state
+        d = dict(key=job, state=state)
         if info:
-            self._request('change', key=job, state=state, info=info)
+            d['info'] = info
+        if rate:
+            d['rate'] = rate
+        return self._request('change', **d)
+
+    def change_states(self, results):
+        """Report many (job, state, info, rate) results in one request."""
+        return self._request('change_batch', results=json.dumps(results))
+
+    def start_reporter(self):
+        """Send results given to report() from a background thread.  They are
+        kept in the journal until the server has them, and whatever a
+        previous run left there is sent first."""
+        self.reports = Queue.Queue()
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        if os.path.exists(self.journal_file):
+            with file(self.journal_file) as f:
+                for line in f:
+                    try:
+                        self.pending.append(json.loads(line))
+                    except ValueError:
+                        # torn last line of a crash
+                        pass
+            if self.pending:
+                print 'resending %d results from %s' % (len(self.pending), self.journal_file)
+            for result in self.pending:
+                self.reports.put(result)
+        self.reporter = threading.Thread(target=self._report_loop)
+        self.reporter.daemon = True
+        self.reporter.start()
+
+    def stop_reporter(self):
+        """Wait until everything reported has been sent."""
+        if self.reporter:
+            self.reports.put(None)
+            self.reporter.join()
+            self.reporter = None
+
+    def report(self, job, state, info, rate=None):
+        result = [job, state, info, rate]
+        if not self.reporter:
+            self.change_state(*result)
+            return
+        with self.pending_lock:
+            self.pending.append(result)
+            with file(self.journal_file, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        self.reports.put(result)
+
+    def _report_loop(self):
+        while True:
+            results = [self.reports.get()]
+            while True:
+                try:
+                    results.append(self.reports.get_nowait())
+                except Queue.Empty:
+                    break
+            done = None in results
+            results = [r for r in results if r is not None]
+
+            if results:
+                self._send(results)
+            if done:
+                return
+
+    def _send(self, results):
+        """Report results and drop them from the journal.  Requests are
+        retried until the server answers; None means it rejected them."""
+        if len(results) == 1:
+            r = self.change_state(*results[0])
         else:
-            self._request('change', key=job, state=state)
+            r = self.change_states(results)
+        if r == 'invalid token':
+            # left in the journal for a run with a valid token
+            print 'reporting failed:', r
+            return
+        if r is None:
+            # a batch is rejected as a whole, find the bad ones
+            for result in results:
+                if len(results) == 1 or self.change_state(*result) is None:
+                    self._reject(result)
+        self._forget(results)
+
+    def _reject(self, result):
+        """Keep a result the server won't take out of the way of the
+        others, for a look by hand."""
+        print 'result rejected:', result
+        with file(self.journal_file + '.rejected', 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+    def _forget(self, results):
+        sent = set(id(r) for r in results)
+        with self.pending_lock:
+            self.pending = [r for r in self.pending if id(r) not in sent]
+            tmp = self.journal_file + '.tmp'
+            with file(tmp, 'w') as f:
+                for result in self.pending:
+                    f.write(json.dumps(result) + '\n')
+            if sys.platform == 'win32':
+                my_unlink(self.journal_file)
+            os.rename(tmp, self.journal_file)
 
     def register(self, name, contact):
-        r = json.loads(self._request('register', name=name, contact=contact))
+        r = self._request('register', name=name, contact=contact)
+        if r is None:
+            sys.exit(1)
+        r = json.loads(r)
         if r['result'] == 'error':
             print 'error:', r['msg']
             sys.exit(1)
@@ -121,14 +533,13 @@ def is_success(logdata, tmp_a, tmp_b, tmp_c):
 
 
 
-def fetch(job):
-    global g_alt_server
-
+def fetch(job, slot=0):
     t, url = json.loads(job)
+    key = url
 
     # prepare
-    if g_alt_server:
-        url = url.replace('mediavod01', 'mediavod02')
+    mirrors = selector.ranked()
+    url = selector.url_for(key, mirrors[0])
 
     fn = util.get_store_path(t, url)
     print url
@@ -140,66 +551,341 @@ def fetch(job):
 
     # start fetch
 
-    pid = os.getpid()
+    # each slot of a parallel run has its own set of tmp files
+    prefix = '%d.%d' % (os.getpid(), slot)
 
-    tmp_a = os.path.join('tmp', '%d.a.wmv' % pid)
-    tmp_b = os.path.join('tmp', '%d.b.wmv' % pid)
-    tmp_c = os.path.join('tmp', '%d.c.wmv' % pid)
-    tmp_log = os.path.join('tmp', '%d.log' % pid)
-    my_unlink(tmp_a)
+    tmp_a = os.path.join('tmp', '%s.a.wmv' % prefix)
+    tmp_b = os.path.join('tmp', '%s.b.wmv' % prefix)
+    tmp_c = os.path.join('tmp', '%s.c.wmv' % prefix)
+    tmp_log = os.path.join('tmp', '%s.log' % prefix)
+    if options.downloader == 'mmsh':
+        # keyed by the original url, so a retry continues the partial
+        # transfer whichever server it was fetched from
+        tmp_a = os.path.join(PARTIAL_DIR, '%s.wmv' % hashlib.sha1(key).hexdigest())
+    else:
+        my_unlink(tmp_a)
     my_unlink(tmp_b)
     my_unlink(tmp_c)
     my_unlink(tmp_log)
 
+    # bytes carried over from an earlier attempt don't count toward the rate
+    size0 = os.path.getsize(tmp_a) if os.path.exists(tmp_a) else 0
+    collector = None
+    t0 = time.time()
+    if options.downloader == 'mmsh':
+        race_url = None
+        # a partial transfer is a head start already
+        if options.race and '-clip' not in key and not size0 and \
+                selector.mirror_of(key):
+            race_url = selector.url_for(key, mirrors[1])
+        success, not_found, url, collector = run_mmsh(url, slot, tmp_a,
+                tmp_log, race_url)
+    else:
+        success, not_found = run_msdl(url, slot, tmp_a, tmp_b, tmp_c, tmp_log)
+
+    # achieved throughput in KB/s, including time spent paused
+    size = sum(os.path.getsize(path) for path in (tmp_a, tmp_b, tmp_c) if os.path.exists(path))
+    rate = round(max(size - size0, 0) / 1024. / max(time.time() - t0, 1), 1)
+    selector.record(selector.mirror_of(url),
+            'downloaded' if success else '404' if not_found else 'failed', rate)
+
+    if success:
+        os.rename(tmp_log, os_filename(fn + '.log'))
+        os.rename(tmp_a, os_filename(fn))
+
+        if collector and collector.size == os.path.getsize(os_filename(fn)):
+            info = collector.info()
+        else:
+            info = util.collect_video_info(os_filename(fn))
+        assert info
+        return dict(state='downloaded', sleep=10, info=json.dumps(info, sort_keys=True), rate=rate)
+
+    if not_found:
+        return dict(state='404', sleep=3, rate=rate)
+    else:
+        return dict(state='failed', sleep=60, rate=rate)
+
+def run_msdl(url, slot, tmp_a, tmp_b, tmp_c, tmp_log):
+    """Returns (success, not_found)."""
     cmd = '"%s" -s 5 -o %s -o %s -o %s "%s" 2>&1 | tee %s' % (
             msdl_bin,
             tmp_a, tmp_b, tmp_c, url, tmp_log)
-    p = subprocess.Popen(cmd, shell=True)
-    p.wait()
+    if governor:
+        # own process group, so the governor can pause msdl and tee together
+        p = subprocess.Popen(cmd, shell=True,
+                preexec_fn=os.setpgrp if sys.platform != 'win32' else None)
+        governor.add(slot, p, [tmp_a, tmp_b, tmp_c])
+        try:
+            p.wait()
+        finally:
+            governor.remove(slot)
+    else:
+        p = subprocess.Popen(cmd, shell=True)
+        p.wait()
 
     logdata = ''
     if os.path.exists(tmp_log):
         logdata = file(tmp_log).read()
-    if is_success(logdata, tmp_a, tmp_b, tmp_c):
-        os.rename(tmp_log, os_filename(fn + '.log'))
-        os.rename(tmp_a, os_filename(fn))
+    return is_success(logdata, tmp_a, tmp_b, tmp_c), '404 (Not Found)' in logdata
 
-        info = util.collect_video_info(os_filename(fn))
-        assert info
-        return dict(state='downloaded', sleep=10, info=json.dumps(info, sort_keys=True))
+def run_mmsh(url, slot, tmp_a, tmp_log, race_url=None):
+    """Returns (success, not_found, url, collector) where url is the one
+    the file came from and collector has its checksum and metadata.  With
+    race_url, url and race_url are downloaded at once for the first
+    options.race seconds and the faster one carries on."""
+    last = [time.time()]
+    def progress(r):
+        if time.time() - last[0] >= 10:
+            last[0] = time.time()
+            print '%(packets)d/%(expected_packets)d packets' % r
 
-    g_alt_server = not g_alt_server
-    if '404 (Not Found)' in logdata:
-        return dict(state='404', sleep=3)
-    else:
-        return dict(state='failed', sleep=60)
+    tmp_race = tmp_a[:-len('.wmv')] + '.race.wmv'
+    if governor:
+        # in-process transfers can't be paused, only counted
+        governor.add(slot, None, [tmp_a, tmp_race])
+    try:
+        with file(tmp_log, 'w') as f:
+            r = None
+            # checksum and metadata are taken from the bytes as they are written
+            collector = util.VideoInfoCollector()
+            if race_url:
+                i, r, collector = race([url, race_url], [tmp_a, tmp_race],
+                        options.race, progress)
+                url = [url, race_url][i]
+                if i:
+                    os.rename(tmp_race, tmp_a)
+                    if os.path.exists(tmp_race + '.progress'):
+                        mmsh.save_progress(tmp_a, mmsh.load_progress(tmp_race))
+                        my_unlink(tmp_race + '.progress')
+                print 'race won by', url
+                print r
+                f.write('%s\n%r\n' % (url, r))
+
+            for i in range(MMSH_RETRY + 1):
+                # retry right away while each attempt gets further
+                if r and (r['result'] not in ('truncated', 'timeout') or
+                        r['packets'] <= r['resumed_packets']):
+                    break
+                r = mmsh.download(url, tmp_a, progress, resume=True,
+                        sink=collector)
+                print r
+                f.write('%s\n%r\n' % (url, r))
+    finally:
+        if governor:
+            governor.remove(slot)
+    return r['result'] == 'ok', r['result'] == '404', url, collector
+
+def race(urls, paths, seconds, progress=None):
+    """Download urls[i] into paths[i] at once, and after seconds cancel all
+    but the one that got furthest.  The losers' files are removed.  Returns
+    (index, result, collector) of the winner, run to its end."""
+    n = len(urls)
+    collectors = [util.VideoInfoCollector() for i in range(n)]
+    cancel = [threading.Event() for i in range(n)]
+    packets = [0] * n
+    results = [None] * n
+    # whose progress is shown
+    lead = [0]
+
+    def run(i):
+        def race_progress(r):
+            packets[i] = r['packets'] - r['resumed_packets']
+            if cancel[i].is_set():
+                raise mmsh.Cancelled()
+            if progress and i == lead[0]:
+                progress(r)
+        results[i] = mmsh.download(urls[i], paths[i], race_progress,
+                resume=True, sink=collectors[i])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    deadline = time.time() + seconds
+    while time.time() < deadline and all(t.is_alive() for t in threads):
+        time.sleep(0.5)
+
+    # a transfer that ended in failure loses to any still going
+    def key(i):
+        failed = results[i] is not None and results[i]['result'] != 'ok'
+        return (not failed, packets[i])
+    winner = lead[0] = max(range(n), key=key)
+    for i in range(n):
+        if i != winner:
+            cancel[i].set()
+    print 'race:', ', '.join('%s %d packets' % (urls[i], packets[i]) for i in range(n))
+    # losers stop at their next packet at the latest
+    for t in threads:
+        t.join()
+    # however they ended, cancelled or failed early
+    for i in range(n):
+        if i != winner:
+            my_unlink(paths[i])
+            my_unlink(paths[i] + '.progress')
+    return winner, results[winner], collectors[winner]
+
+def clean_partial():
+    """Drop partial transfers nobody resumed for PARTIAL_MAX_AGE, most likely
+    finished by another client meanwhile."""
+    if not os.path.exists(PARTIAL_DIR):
+        os.mkdir(PARTIAL_DIR)
+    for name in os.listdir(PARTIAL_DIR):
+        path = os.path.join(PARTIAL_DIR, name)
+        if os.path.getmtime(path) < time.time() - PARTIAL_MAX_AGE:
+            my_unlink(path)
+
+class Governor:
+    """Holds the aggregate rate of all msdl transfers near rate KB/s.
+
+    The bytes written to each transfer's tmp files are sampled every second
+    and charged to a token bucket.  When the bucket runs dry the newest
+    transfer is paused (SIGSTOP to its process group) until the bucket
+    refills.  allowed() tells the Scheduler how many transfers to run: one
+    more while the target is not met, fewer once transfers have to be
+    paused.  On win32 transfers can't be paused, so only the number of
+    transfers is adjusted.
+    """
+    interval = 1.0
+    # seconds a new transfer gets to ramp up before growing again
+    settle = 30
+
+    def __init__(self, rate, max_transfers=1):
+        self.rate = rate * 1024
+        self.burst = self.rate * 5
+        self.tokens = self.burst
+        self.max_transfers = max_transfers
+        self.limit = 1
+        self.changed = time.time()
+        self.achieved = 0.0
+        self.transfers = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def allowed(self):
+        return self.limit
+
+    def add(self, slot, proc, paths):
+        # a resumed partial is already on disk, only charge what comes after
+        size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+        with self.lock:
+            self.transfers[slot] = dict(proc=proc, paths=paths, size=size,
+                    start=time.time(), paused=False)
+
+    def remove(self, slot):
+        with self.lock:
+            t = self.transfers.pop(slot)
+            paused = t['paused']
+            if t['proc'] is not None and t['proc'].poll() is None:
+                # left early, don't leave msdl running in its own group
+                self._signal(t, 'SIGTERM')
+            if paused:
+                self._signal(t, 'SIGCONT')
+
+    def terminate(self, signum):
+        """Pass signum on to every msdl process group.  ^C from the terminal
+        and a kill of this process don't reach them by themselves."""
+        with self.lock:
+            for t in self.transfers.values():
+                if t['proc'] is None:
+                    continue
+                try:
+                    os.killpg(t['proc'].pid, signum)
+                    if t['paused']:
+                        os.killpg(t['proc'].pid, signal.SIGCONT)
+                except OSError:
+                    pass
+
+    def _signal(self, t, name):
+        if t['proc'] is None or not hasattr(signal, name):
+            return False
+        try:
+            os.killpg(t['proc'].pid, getattr(signal, name))
+        except OSError:
+            return False
+        t['paused'] = name == 'SIGSTOP'
+        return True
+
+    def run(self):
+        last = time.time()
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            with self.lock:
+                self.sample(now - last)
+            last = now
+
+    def sample(self, dt):
+        written = 0
+        for t in self.transfers.values():
+            size = sum(os.path.getsize(path) for path in t['paths'] if os.path.exists(path))
+            written += max(size - t['size'], 0)
+            t['size'] = size
+        self.achieved = 0.8 * self.achieved + 0.2 * written / dt
+        self.tokens = min(self.burst, self.tokens + self.rate * dt - written)
+
+        running = sorted((t['start'], t) for t in self.transfers.values() if not t['paused'])
+        paused = sorted((t['start'], t) for t in self.transfers.values() if t['paused'])
+        now = time.time()
+        if self.tokens < 0 and running:
+            if self._signal(running[-1][1], 'SIGSTOP'):
+                print 'governor: pause, %.1f KB/s' % (self.achieved / 1024)
+            if self.limit > 1:
+                self.limit = max(1, len(self.transfers) - 1)
+                self.changed = now
+        elif self.tokens > 0 and paused:
+            self._signal(paused[0][1], 'SIGCONT')
+        elif (self.achieved < 0.8 * self.rate and not paused
+                and len(self.transfers) >= self.limit
+                and self.limit < self.max_transfers
+                and now - self.changed > self.settle):
+            self.limit += 1
+            self.changed = now
+            print 'governor: %d transfers, %.1f KB/s' % (self.limit, self.achieved / 1024)
 
 def worker(bw):
+    try:
+        serial_loop(bw)
+    finally:
+        # a job leased ahead is given back however the loop ends
+        jm.release_prefetched()
+
+def serial_loop(bw):
     while True:
         print '-'*30
 
-        job = jm.get(bw)
+        job = jm.get(bw, wait=LONG_POLL)
+        # servers without long-poll answer right away
+        polled = jm.last_poll > LONG_POLL / 2
         if options.verbose:
             print 'job', job
         if not job:
             break
         if job == 'done':
             print 'done'
+            if polled:
+                continue
             break
         if job == 'wait':
             print 'wait'
-            time.sleep(60 * 10)
+            if not polled:
+                time.sleep(60 * 10)
             continue
 
+        # lease the next job while this one downloads
+        jm.prefetch(bw, wait=LONG_POLL)
         result = None
         try:
             result = fetch(job)
         finally:
             if not result:
                 result = dict(state='failed', sleep=60*10)
-            jm.change_state(job, result['state'], result.get('info'))
+            jm.report(job, result['state'], result.get('info'), result.get('rate'))
 
-        if os.path.exists('stop-download') and os.path.getmtime('stop-download') > program_start_time:
+        if stop_requested():
             print 'stop-download'
             break
 
@@ -207,6 +893,115 @@ def worker(bw):
             print 'sleep', result['sleep'], 'seconds'
             time.sleep(result['sleep'])
 
+def forward_signal(signum, frame):
+    governor.terminate(signum)
+    if signum == signal.SIGINT:
+        raise KeyboardInterrupt
+    raise SystemExit(128 + signum)
+
+def stop_requested():
+    return os.path.exists('stop-download') and os.path.getmtime('stop-download') > program_start_time
+
+class Scheduler:
+    """Keeps up to n transfers running at once.
+
+    Free slots are filled with jobs leased in one batch, each transfer runs
+    in its own thread, and results go through the JobManager reporter so a
+    slow /change never delays the next claim.
+    """
+    def __init__(self, bw, n):
+        self.bw = bw
+        self.n = n
+        self.free = Queue.Queue()
+        for slot in range(n):
+            self.free.put(slot)
+
+    def take_slot(self):
+        # a get() without timeout can't be interrupted, not even by ^C
+        while True:
+            try:
+                return self.free.get(timeout=60)
+            except Queue.Empty:
+                pass
+
+    def run(self):
+        self.claim_loop()
+
+        # let running transfers finish
+        for i in range(self.n):
+            self.take_slot()
+
+    def claim_loop(self):
+        while True:
+            if stop_requested():
+                print 'stop-download'
+                return
+            print '-'*30
+            slots = [self.take_slot()]
+            # whatever is left in slots goes back to free, however this
+            # round ends, or run() would wait for it forever
+            try:
+                while True:
+                    try:
+                        slots.append(self.free.get_nowait())
+                    except Queue.Empty:
+                        break
+                if governor:
+                    busy = self.n - self.free.qsize() - len(slots)
+                    room = max(governor.allowed() - busy, 0)
+                    for slot in slots[room:]:
+                        self.free.put(slot)
+                    slots = slots[:room]
+                    if not slots:
+                        time.sleep(5)
+                        continue
+
+                t0 = time.time()
+                jobs = jm.get_batch(self.bw, len(slots), wait=LONG_POLL)
+                polled = time.time() - t0 > LONG_POLL / 2
+                if options.verbose:
+                    print 'jobs', jobs
+                if not jobs:
+                    return
+                if jobs in ('done', 'wait'):
+                    print jobs
+                    busy = self.n - self.free.qsize() - len(slots)
+                    for slot in slots:
+                        self.free.put(slot)
+                    slots = []
+                    if polled:
+                        continue
+                    if jobs == 'done' and not busy:
+                        return
+                    time.sleep(60 * 10 if jobs == 'wait' else 60)
+                    continue
+
+                for job in jobs[:len(slots)]:
+                    t = threading.Thread(target=self.transfer,
+                            args=(slots[0], job))
+                    t.daemon = True
+                    t.start()
+                    # the transfer gives it back now
+                    slots.pop(0)
+            finally:
+                for slot in slots:
+                    self.free.put(slot)
+
+    def transfer(self, slot, job):
+        result = None
+        try:
+            result = fetch(job, slot)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if not result:
+                result = dict(state='failed', sleep=60*10)
+            jm.report(job, result['state'], result.get('info'), result.get('rate'))
+            if result['sleep']:
+                print 'slot', slot, 'sleep', result['sleep'], 'seconds'
+                time.sleep(result['sleep'])
+            self.free.put(slot)
+
 def check_dependency():
     if not os.path.exists('tmp'):
         os.mkdir('tmp')
@@ -214,6 +1009,10 @@ def check_dependency():
     assert 'sha512' in hashlib.algorithms
     assert hashlib.sha512('hello').hexdigest() == '9b71d224bd62f3785d96d46ad3ea3d73319bfbc2890caadae2dff72519673ca72323c3d99ba5c11d7c7acc6e14b8c5da0c4663475c2e5c3adef46f73bcdec043'
 
+    if options.downloader == 'mmsh':
+        clean_partial()
+        return
+
     global msdl_bin
     if options.msdl_bin:
         msdl_bin = options.msdl_bin
@@ -232,7 +1031,7 @@ def usage():
     print '''
 Commands are:
     register <name> <contact>
-    run {high|low}
+    run [--parallel N] [--rate KB/s] [--race SECONDS] {high|mid|low}
         high <= 500KB/s
         mid <= 230KB/s
         low <= 70KB/s
@@ -240,6 +1039,7 @@ Commands are:
 
 def main():
     global jm
+    global governor
     global options
     global args
 
@@ -265,12 +1065,27 @@ def main():
         return
 
     if cmd == 'run':
+        if options.rate:
+            governor = Governor(options.rate, options.parallel)
+            governor.start()
+            if sys.platform != 'win32':
+                # msdl runs in its own process group under the governor
+                signal.signal(signal.SIGINT, forward_signal)
+                signal.signal(signal.SIGTERM, forward_signal)
         if args:
             bw = args.pop(0)
             assert bw in ('low', 'high', 'mid')
         else:
             bw = 'high'
-        worker(bw)
+        jm.start_reporter()
+        if options.parallel > 1:
+            Scheduler(bw, options.parallel).run()
+        else:
+            worker(bw)
+        jm.stop_reporter()
+        if options.verbose:
+            print json.dumps(jm.stats(), indent=1, sort_keys=True)
+            print json.dumps(selector.stats(), indent=1, sort_keys=True)
 
 if __name__ == '__main__':
     main()
@@ -1,13 +1,295 @@
 import json
+import time
+import select
+import threading
+import traceback
+import collections
 
 import psycopg2
+import psycopg2.extensions
+
+DSN = 'dbname=ivod user=ivod'
+
+# give up on a key after this many 404 responses
+MAX_404 = 10
+
+# how long a handed out job stays leased before it is considered abandoned
+LEASE = "CASE clip WHEN 1 THEN interval '12 hours' ELSE interval '24 hours' END"
+
+# When a job in the given state becomes eligible to be handed out (again):
+# never tried, abandoned downloads, and retries of failed/404 after a pause.
+# NULL for states that are finished.  Substitute state and ts (the time the
+# state was entered) with SQL expressions.
+ELIGIBLE_AT = '''CASE %(state)s
+            WHEN 'no' THEN %(ts)s
+            WHEN 'downloading' THEN %(ts)s + ''' + LEASE + '''
+            WHEN 'failed' THEN %(ts)s + interval '10 minutes'
+            WHEN '404' THEN %(ts)s + interval '10 minutes'
+            END'''
+
+# served by the partial indexes on eligible_at, see ivod.schema
+ELIGIBLE_COND = 'eligible_at <= now()'
+
+# bw, clip; each class has a partial index in ivod.schema whose predicate
+# must stay textually identical to the condition here
+# 0, 0  200KB/s
+# 0, 1  500KB/s
+# 1, 0  70KB/s
+# 1, 1  70KB/s
+BW_COND = {
+        'high': 'true',
+        # bw, clip != 0, 1
+        'mid': '(bw = 1 OR clip = 0)',
+        # bw = 1
+        'low': '(bw = 1)',
+        }
+
+# NOTIFY channel signalled when a job is added in state 'no'; jobs becoming
+# eligible again later are found through DB.seconds_to_eligible
+JOB_CHANNEL = 'ivod_job'
+
+STATUS_SQL = '''
+    SELECT
+        date_part('year', videodate)::int as year,
+        clip,
+        bw,
+        state,
+        count(*)::int as count
+    FROM download_state
+    GROUP BY year, clip, bw, state'''
+
+# the counters as of now: folded totals plus the deltas not folded in yet
+SUMMARY_SQL = '''
+    SELECT year, clip, bw, state, sum(count)::int as count
+    FROM (
+        SELECT year, clip, bw, state, count
+        FROM download_status_summary
+        UNION ALL
+        SELECT year, clip, bw, state, delta
+        FROM download_status_delta
+        ) counts
+    GROUP BY year, clip, bw, state'''
+
+class Pool:
+    """Thread-safe pool of at most maxconn connections.
+
+    getconn() blocks while all connections are checked out.  Connections
+    idle for more than check_idle seconds are pinged before being handed out
+    and replaced if they went bad.
+    """
+    def __init__(self, dsn=DSN, maxconn=10, check_idle=30):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.check_idle = check_idle
+        self._idle = []  # (conn, returned_at)
+        self._size = 0
+        self._cond = threading.Condition()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.connects = 0
+        self.discards = 0
+
+    def _healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.time() - returned_at < self.check_idle:
+            return True
+        try:
+            c = conn.cursor()
+            c.execute('SELECT 1')
+            c.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        t0 = time.time()
+        with self._cond:
+            while not self._idle and self._size >= self.maxconn:
+                self._cond.wait()
+            waited = time.time() - t0
+            self.checkouts += 1
+            if waited > 0.001:
+                self.waits += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn, returned_at = None, None
+                self._size += 1
+
+        # connect and ping outside the lock
+        if conn is not None and not self._healthy(conn, returned_at):
+            self._discard(conn, keep_slot=True)
+            conn = None
+        if conn is None:
+            try:
+                conn = psycopg2.connect(self.dsn)
+            except:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self.connects += 1
+        return conn
+
+    def putconn(self, conn):
+        if not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                pass
+        if conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def _discard(self, conn, keep_slot=False):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self.discards += 1
+            if not keep_slot:
+                self._size -= 1
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                    size=self._size,
+                    idle=len(self._idle),
+                    maxconn=self.maxconn,
+                    checkouts=self.checkouts,
+                    waits=self.waits,
+                    wait_time=self.wait_time,
+                    max_wait_time=self.max_wait_time,
+                    avg_wait_time=self.wait_time / self.checkouts if self.checkouts else 0,
+                    connects=self.connects,
+                    discards=self.discards,
+                    )
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds."""
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[1] < time.time():
+                self.misses += 1
+                return None
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time() + self.ttl)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(size=len(self._data), maxsize=self.maxsize,
+                    hits=self.hits, misses=self.misses)
+
+class Listener:
+    """Follows NOTIFY on channel from a background thread.
+
+    seq increases whenever notifications arrive (or the connection was
+    re-established and some may have been missed); wait() blocks until it
+    moves past a value read earlier.
+    """
+    def __init__(self, channel=JOB_CHANNEL, dsn=DSN):
+        self.channel = channel
+        self.dsn = dsn
+        self.seq = 0
+        self._cond = threading.Condition()
+
+    def start(self):
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def wait(self, seq, timeout):
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.seq == seq:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self.seq
+
+    def _bump(self):
+        with self._cond:
+            self.seq += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                c = conn.cursor()
+                c.execute('LISTEN ' + self.channel)
+                c.close()
+                self._bump()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        del conn.notifies[:]
+                        self._bump()
+            except psycopg2.Error:
+                traceback.print_exc()
+                if conn is not None:
+                    conn.close()
+                time.sleep(5)
+
+# users.token by name; tokens never change once issued
+token_cache = TTLCache(maxsize=1024, ttl=600)
 
 class DB:
-    def __init__(self):
-        self.conn = psycopg2.connect('dbname=ivod user=ivod')
+    def __init__(self, dsn=DSN, pool=None):
+        self.pool = pool
+        if pool:
+            self.conn = pool.getconn()
+        else:
+            self.conn = psycopg2.connect(dsn)
 
     def close(self):
-        self.conn.close()
+        if self.conn is None:
+            return
+        if self.pool:
+            self.pool.putconn(self.conn)
+        else:
+            self.conn.close()
         self.conn = None
     
     def query(self, sql, *bind):
@@ -25,27 +307,92 @@ class DB:
         c.close()
 
     def get_user_token(self, name):
+        token = token_cache.get(name)
+        if token is not None:
+            return token
         rows = self.query('SELECT token FROM users WHERE name = %s LIMIT 1', name)
         if not rows:
             return None
+        token_cache.set(name, rows[0][0])
         return rows[0][0]
 
     def add_user_token(self, name, contact, token):
         with self.conn:
             self.modify('INSERT INTO users (name, contact, token) VALUES (%s,%s,%s)',
                 name, contact, token)
+        token_cache.invalidate(name)
 
     def get_metadata(self, vid):
         return self.query('SELECT data FROM metadata WHERE vid = %s', vid)
 
-    def change_job_state(self, key, name, state):
+    def change_job_state(self, key, name, state, rate=None, claim_id=None):
+        """rate is the client's achieved download rate in KB/s, if known.
+        claim_id marks the request that leased the job, see claim_jobs."""
+        rows = self.query('''
+        SELECT date_part('year', videodate)::int, clip, bw, state
+        FROM download_state
+        WHERE key = %s
+        FOR UPDATE''', key)
         self.modify('''
         UPDATE download_state 
-        SET state = %s, username = %s, last_modified = now()
+        SET state = %s, username = %s, last_modified = now(),
+            count_404 = count_404 + (%s = '404')::int,
+            count_failed = count_failed + (%s = 'failed')::int,
+            count_downloaded = count_downloaded + (%s = 'downloaded')::int,
+            eligible_at = ''' + ELIGIBLE_AT % dict(state='%s', ts='now()') + ''',
+            claim_id = %s
         WHERE key = %s''',
-                state, name, key)
-        self.modify('INSERT INTO download_state_history (key,username, state) VALUES (%s,%s,%s)',
-                key, name, state)
+                state, name, state, state, state, state, claim_id, key)
+        self.modify('INSERT INTO download_state_history (key,username, state, rate) VALUES (%s,%s,%s,%s)',
+                key, name, state, rate)
+        if state == 'no':
+            self.modify('NOTIFY ' + JOB_CHANNEL)
+        if rows:
+            year, clip, bw, old_state = rows[0]
+            if old_state != state:
+                self.count_status(year, clip, bw, old_state, -1)
+                self.count_status(year, clip, bw, state, 1)
+
+    def release_job(self, key):
+        """Put a leased job back to 'no' without recording an attempt."""
+        rows = self.query('''
+        UPDATE download_state
+        SET state = 'no', last_modified = now(), eligible_at = now(),
+            claim_id = NULL
+        WHERE key = %s AND state = 'downloading'
+        RETURNING date_part('year', videodate)::int, clip, bw''', key)
+        if rows:
+            year, clip, bw = rows[0]
+            self.count_status(year, clip, bw, 'downloading', -1)
+            self.count_status(year, clip, bw, 'no', 1)
+            self.modify('NOTIFY ' + JOB_CHANNEL)
+
+    def count_status(self, year, clip, bw, state, delta):
+        # append only, so concurrent state changes don't queue on (or
+        # deadlock over) the shared counter rows; see fold_status_deltas
+        self.modify('''
+        INSERT INTO download_status_delta (year, clip, bw, state, delta)
+        VALUES (%s, %s, %s, %s, %s)''',
+                year, clip, bw, state, delta)
+
+    def fold_status_deltas(self):
+        """Move the pending download_status_delta rows into
+        download_status_summary.  Returns how many rows were folded."""
+        with self.conn:
+            rows = self.query('''
+            WITH moved AS (
+                DELETE FROM download_status_delta
+                RETURNING year, clip, bw, state, delta
+            ), folded AS (
+                INSERT INTO download_status_summary (year, clip, bw, state, count)
+                SELECT year, clip, bw, state, sum(delta)::int
+                FROM moved
+                GROUP BY year, clip, bw, state
+                ON CONFLICT (year, clip, bw, state)
+                DO UPDATE SET count = download_status_summary.count + EXCLUDED.count
+            )
+            SELECT count(*) FROM moved''')
+        return rows[0][0]
 
     def add_upload_state(self, key, state, youtube_id):
         self.modify('''
@@ -68,10 +415,82 @@ class DB:
         return rows[0]
 
     def add_job_state(self, key, name, state, bw,clip,videodate):
-        self.modify('INSERT INTO download_state(key,username,state,bw,clip,videodate) VALUES(%s,%s,%s,%s,%s,%s)',
+        rows = self.query('INSERT INTO download_state(key,username,state,bw,clip,videodate) VALUES(%s,%s,%s,%s,%s,%s) RETURNING date_part(\'year\', videodate)::int',
                 key,name,'no', bw, clip, videodate)
+        self.count_status(rows[0][0], clip, bw, 'no', 1)
         if state != 'no':
             self.change_job_state(key, name, state)
+        else:
+            self.modify('NOTIFY ' + JOB_CHANNEL)
+
+    def count_404(self, key):
+        rows = self.query('SELECT count_404 FROM download_state WHERE key = %s', key)
+        if not rows:
+            return 0
+        return rows[0][0]
+
+    def claim_jobs(self, name, bw=None, n=1, claim_id=None):
+        """Hand out up to n eligible jobs to name, oldest first.
+
+        Rows locked by a concurrent claim are skipped rather than waited on,
+        so simultaneous callers each get a different job.  The whole batch is
+        leased in one transaction.  Returns a list of (key, videodate, lease)
+        and commits.
+
+        A request sent again with the same claim_id, because its answer got
+        lost, gets the jobs the first one leased instead of more.
+        """
+        jobs = []
+        with self.conn:
+            if claim_id:
+                rows = self.query('''
+                SELECT key, videodate, %s
+                FROM download_state
+                WHERE claim_id = %%s AND username = %%s AND state = 'downloading'
+                ''' % LEASE, claim_id, name)
+                if rows:
+                    return [tuple(row) for row in rows]
+            while len(jobs) < n:
+                # rows changed in earlier rounds are no longer eligible, so
+                # they don't come back although this transaction holds them
+                rows = self.query('''
+                SELECT key, videodate, state, count_404, %s
+                FROM download_state
+                WHERE %s AND %s
+                ORDER BY eligible_at
+                LIMIT %%s
+                FOR UPDATE SKIP LOCKED
+                ''' % (LEASE, ELIGIBLE_COND, BW_COND.get(bw, 'true')),
+                        n - len(jobs))
+                if not rows:
+                    break
+                for key, videodate, state, count_404, lease in rows:
+                    if state == '404' and count_404 >= MAX_404:
+                        self.change_job_state(key, name, '404skip')
+                        continue
+                    self.change_job_state(key, name, 'downloading',
+                            claim_id=claim_id)
+                    jobs.append((key, videodate, lease))
+        return jobs
+
+    def seconds_to_eligible(self, bw=None):
+        """Seconds until the next job of bandwidth class bw becomes eligible,
+        or None when there is none."""
+        rows = self.query('''
+        SELECT extract(epoch FROM min(eligible_at) - now())
+        FROM download_state
+        WHERE eligible_at IS NOT NULL AND %s''' % BW_COND.get(bw, 'true'))
+        if not rows or rows[0][0] is None:
+            return None
+        return float(rows[0][0])
+
+    def lock_job_state(self, key):
+        """(state, username) of key, locked until the end of the
+        transaction, or None."""
+        rows = self.query('SELECT state, username FROM download_state WHERE key = %s FOR UPDATE', key)
+        if not rows:
+            return None
+        return rows[0]
 
     def get_job_state(self, key):
         rows = self.query('SELECT state FROM download_state WHERE key = %s LIMIT 1', key)
@@ -91,14 +510,32 @@ class DB:
 
     def get_status(self):
         return self.query('''
-                SELECT 
-                    date_part('year', videodate)::int as year,
-                    clip, 
-                    bw, 
-                    state,
-                    count(*) 
-                FROM download_state 
-                GROUP BY year, clip, bw, state''')
+                SELECT year, clip, bw, state, count
+                FROM (%s) summary
+                WHERE count != 0''' % SUMMARY_SQL)
+
+    def diff_status_summary(self):
+        """Compare the counters (with pending deltas) against a full count of
+        download_state.  Returns (year, clip, bw, state, expected, actual)
+        for every counter that is off."""
+        return self.query('''
+                SELECT year, clip, bw, state,
+                    coalesce(actual.count, 0), coalesce(summary.count, 0)
+                FROM (%s) actual
+                FULL JOIN (%s) summary
+                    USING (year, clip, bw, state)
+                WHERE coalesce(actual.count, 0) != coalesce(summary.count, 0)'''
+                % (STATUS_SQL, SUMMARY_SQL))
+
+    def rebuild_status_summary(self):
+        with self.conn:
+            # block state changes while recounting
+            self.modify('LOCK TABLE download_state IN SHARE MODE')
+            self.modify('DELETE FROM download_status_summary')
+            self.modify('DELETE FROM download_status_delta')
+            self.modify('''
+                INSERT INTO download_status_summary (year, clip, bw, state, count)
+                %s''' % STATUS_SQL)
 
     def get_all_download_state(self):
         return self.query('SELECT key,state FROM download_state')
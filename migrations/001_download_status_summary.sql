@@ -0,0 +1,19 @@
+-- counters for /status and the index page, see DB.get_status
+CREATE TABLE download_status_summary (
+    year INTEGER,
+    clip INTEGER,
+    bw INTEGER,
+    state text,
+    count INTEGER DEFAULT 0,
+    PRIMARY KEY (year, clip, bw, state)
+);
+
+BEGIN;
+LOCK TABLE download_state IN SHARE MODE;
+INSERT INTO download_status_summary (year, clip, bw, state, count)
+    SELECT date_part('year', videodate)::int, clip, bw, state, count(*)::int
+    FROM download_state
+    GROUP BY 1, 2, 3, 4;
+COMMIT;
+
+-- vim:ft=sql
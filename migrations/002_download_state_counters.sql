@@ -0,0 +1,24 @@
+-- per-key attempt counters maintained by DB.change_job_state
+ALTER TABLE download_state
+    ADD COLUMN count_404 INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN count_failed INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN count_downloaded INTEGER NOT NULL DEFAULT 0;
+
+BEGIN;
+LOCK TABLE download_state IN SHARE MODE;
+UPDATE download_state
+SET count_404 = h.count_404,
+    count_failed = h.count_failed,
+    count_downloaded = h.count_downloaded
+FROM (
+    SELECT key,
+        count(*) FILTER (WHERE state = '404') AS count_404,
+        count(*) FILTER (WHERE state = 'failed') AS count_failed,
+        count(*) FILTER (WHERE state = 'downloaded') AS count_downloaded
+    FROM download_state_history
+    GROUP BY key
+    ) h
+WHERE download_state.key = h.key;
+COMMIT;
+
+-- vim:ft=sql
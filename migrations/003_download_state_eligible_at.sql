@@ -0,0 +1,21 @@
+-- precomputed eligibility for /next, see ivod_db.ELIGIBLE_AT
+
+-- the column gets its default together with the backfill; ADD COLUMN locks
+-- the table until COMMIT, so no row can be inserted without either
+BEGIN;
+ALTER TABLE download_state ADD COLUMN eligible_at TIMESTAMP DEFAULT now();
+UPDATE download_state
+SET eligible_at = CASE state
+    WHEN 'no' THEN last_modified
+    WHEN 'downloading' THEN last_modified + CASE clip WHEN 1 THEN interval '12 hours' ELSE interval '24 hours' END
+    WHEN 'failed' THEN last_modified + interval '10 minutes'
+    WHEN '404' THEN last_modified + interval '10 minutes'
+    END;
+COMMIT;
+
+CREATE INDEX download_state_eligible ON download_state(eligible_at) WHERE eligible_at IS NOT NULL;
+CREATE INDEX download_state_eligible_mid ON download_state(eligible_at) WHERE eligible_at IS NOT NULL AND (bw = 1 OR clip = 0);
+CREATE INDEX download_state_eligible_low ON download_state(eligible_at) WHERE eligible_at IS NOT NULL AND (bw = 1);
+ANALYZE download_state;
+
+-- vim:ft=sql
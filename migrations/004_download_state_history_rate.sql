@@ -0,0 +1,4 @@
+-- download rate reported with /change, see DB.change_job_state
+ALTER TABLE download_state_history ADD COLUMN rate REAL;
+
+-- vim:ft=sql
@@ -0,0 +1,10 @@
+-- append-only counter changes, see DB.count_status and DB.fold_status_deltas
+CREATE TABLE download_status_delta (
+    year INTEGER,
+    clip INTEGER,
+    bw INTEGER,
+    state text,
+    delta INTEGER
+);
+
+-- vim:ft=sql
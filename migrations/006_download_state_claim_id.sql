@@ -0,0 +1,6 @@
+-- the /next request that leased a job, see DB.claim_jobs
+ALTER TABLE download_state ADD COLUMN claim_id text;
+
+CREATE INDEX download_state_claim ON download_state(claim_id) WHERE claim_id IS NOT NULL;
+
+-- vim:ft=sql
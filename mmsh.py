@@ -0,0 +1,428 @@
+#!/usr/local/bin/python
+# MMS over HTTP (MMSH) downloader.
+#
+# Streams the ASF header and data packets of an mms:// url straight into a
+# file and reports the outcome as a dict instead of a log to grep:
+#
+#   result  'ok', '404', 'timeout', 'truncated', 'cancelled' or 'error'
+#   bytes   bytes written
+#   packets data packets written
+#   expected_packets  packet count announced by the header, 0 if unknown
+#   resumed_packets   packets kept from an earlier attempt (see resume)
+#   error   message for anything but 'ok'
+#
+# StandInServer serves recorded ASF files over the same protocol, e.g. to
+# exercise the downloader without the real media servers:
+#
+#   python mmsh.py serve video/2013/03/15 8000
+#   python mmsh.py download mmsh://127.0.0.1:8000/some.wmv out.wmv
+import os
+import re
+import sys
+import json
+import uuid
+import socket
+import struct
+import hashlib
+import httplib
+import urllib
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+CHUNK_RESET = 0x4324    # $C
+CHUNK_DATA = 0x4424     # $D
+CHUNK_END = 0x4524      # $E
+CHUNK_HEADER = 0x4824   # $H
+
+# length of the extended header following each chunk header
+CHUNK_EXT_LEN = {
+        CHUNK_RESET: 4,
+        CHUNK_DATA: 8,
+        CHUNK_END: 4,
+        CHUNK_HEADER: 8,
+        }
+
+USER_AGENT = 'NSPlayer/4.1.0.3856'
+
+ASF_HEADER_GUID = uuid.UUID('75B22630-668E-11CF-A6D9-00AA0062CE6C').bytes_le
+ASF_FILE_PROPERTIES_GUID = uuid.UUID('8CABDCA1-A947-11CF-8EE4-00C00C205365').bytes_le
+ASF_STREAM_PROPERTIES_GUID = uuid.UUID('B7DC0791-A9B7-11CF-8EE6-00C00C205365').bytes_le
+
+# ASF data object header that follows the header object
+ASF_DATA_HEADER_LEN = 50
+
+class Truncated(Exception):
+    pass
+
+class Cancelled(Exception):
+    """Raised by a progress callback to stop the download."""
+    pass
+
+def parse_header(data):
+    """Pick what streaming needs out of a raw ASF header.  Returns a dict
+    with header_len (including the data object header), packet_size,
+    packet_count, file_size and stream_ids, or raises ValueError."""
+    if len(data) < 30:
+        raise ValueError('short ASF header')
+    guid, size, count = struct.unpack_from('<16sQI', data, 0)
+    if guid != ASF_HEADER_GUID:
+        raise ValueError('not an ASF header')
+
+    d = dict(header_len=size + ASF_DATA_HEADER_LEN, stream_ids=[])
+    pos = 30
+    for i in range(count):
+        if pos + 24 > len(data):
+            raise ValueError('short ASF header')
+        guid, object_size = struct.unpack_from('<16sQ', data, pos)
+        if object_size < 24:
+            raise ValueError('bad ASF object size')
+        if guid == ASF_FILE_PROPERTIES_GUID:
+            d['file_size'], = struct.unpack_from('<Q', data, pos + 40)
+            d['packet_count'], = struct.unpack_from('<Q', data, pos + 56)
+            d['packet_size'], = struct.unpack_from('<I', data, pos + 92)
+        elif guid == ASF_STREAM_PROPERTIES_GUID:
+            flags, = struct.unpack_from('<H', data, pos + 72)
+            d['stream_ids'].append(flags & 0x7f)
+        pos += object_size
+
+    if 'packet_size' not in d or not d['packet_size']:
+        raise ValueError('no file properties in ASF header')
+    return d
+
+def split_url(url):
+    """mms://, mmsh:// and http:// urls all map to the same http request."""
+    u = urlparse.urlsplit(url)
+    path = u.path or '/'
+    if u.query:
+        path += '?' + u.query
+    return u.hostname, u.port or 80, path
+
+def read_exact(r, n):
+    data = r.read(n)
+    while len(data) < n:
+        more = r.read(n - len(data))
+        if not more:
+            raise Truncated('connection closed mid chunk')
+        data += more
+    return data
+
+def read_chunk(r):
+    """Returns (type, sequence, body), or (None, None, None) at the end of
+    the response."""
+    head = r.read(4)
+    if not head:
+        return None, None, None
+    if len(head) < 4:
+        head += read_exact(r, 4 - len(head))
+    ctype, length = struct.unpack('<HH', head)
+    ext_len = CHUNK_EXT_LEN.get(ctype, 0)
+    if length < ext_len:
+        raise ValueError('bad chunk length')
+    ext = read_exact(r, ext_len)
+    seq = None
+    if ctype in (CHUNK_DATA, CHUNK_END):
+        seq, = struct.unpack_from('<I', ext)
+    body = read_exact(r, length - ext_len)
+    return ctype, seq, body
+
+def pack_chunk(ctype, seq, body=''):
+    ext_len = CHUNK_EXT_LEN[ctype]
+    if ext_len == 8:
+        return struct.pack('<HHIHH', ctype, len(body) + 8, seq, 0,
+                len(body) + 8) + body
+    return struct.pack('<HHI', ctype, len(body) + 4, seq) + body
+
+def open_stream(host, port, path, client_guid, timeout, stream_ids=None,
+        offset=None):
+    """First request (stream_ids None) describes the stream, the second one
+    plays the given streams, from byte offset if given."""
+    conn = httplib.HTTPConnection(host, port, timeout=timeout)
+    headers = {
+            'Accept': '*/*',
+            'User-Agent': USER_AGENT,
+            'Connection': 'Close',
+            }
+    if stream_ids is None:
+        pragma = ['no-cache,rate=1.000000,stream-time=0,stream-offset=0:0,'
+                'request-context=1,max-duration=0']
+    else:
+        if offset:
+            offset = '%d:%d' % (offset >> 32, offset & 0xffffffff)
+        else:
+            offset = '4294967295:4294967295'
+        pragma = ['no-cache,rate=1.000000,stream-time=0,'
+                'stream-offset=%s,' % offset +
+                'request-context=2,max-duration=0',
+                'xPlayStrm=1',
+                'stream-switch-count=%d' % len(stream_ids),
+                'stream-switch-entry=%s' % ' '.join(
+                    'ffff:%d:0' % i for i in stream_ids)]
+    pragma.append('xClientGUID=%s' % client_guid)
+    headers['Pragma'] = ', '.join(pragma)
+    conn.request('GET', path, headers=headers)
+    return conn, conn.getresponse()
+
+def read_header(r):
+    header = ''
+    while True:
+        ctype, seq, body = read_chunk(r)
+        if ctype != CHUNK_HEADER:
+            return header, ctype, seq, body
+        header += body
+
+def load_progress(fn):
+    try:
+        with file(fn + '.progress') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def save_progress(fn, record):
+    tmp = fn + '.progress.tmp'
+    with file(tmp, 'w') as f:
+        json.dump(record, f)
+    try:
+        os.rename(tmp, fn + '.progress')
+    except OSError:
+        # win32 doesn't rename over an existing file
+        os.unlink(fn + '.progress')
+        os.rename(tmp, fn + '.progress')
+
+def remove_progress(fn):
+    if os.path.exists(fn + '.progress'):
+        os.unlink(fn + '.progress')
+
+def resume_point(fn, record):
+    """Number of complete data packets of fn that can be kept, going by its
+    progress record and record, the description of the stream now."""
+    saved = load_progress(fn)
+    if not saved or not os.path.exists(fn):
+        return 0
+    for k in ('header', 'file_size', 'packet_size', 'header_len'):
+        if saved.get(k) != record[k]:
+            return 0
+    on_disk = (os.path.getsize(fn) - record['header_len']) // record['packet_size']
+    return max(0, min(saved.get('packets', 0), on_disk))
+
+class Discontinuity(Exception):
+    pass
+
+def download(url, fn, progress=None, timeout=30, resume=False, sink=None):
+    """Download url into fn.  progress, if given, is called with the result
+    dict after every data packet.  sink, if given, gets update() calls with
+    everything written to fn, in order, after a reset().
+
+    With resume, fn and its fn.progress record are left behind when the
+    transfer fails, and a later call for the same file continues after the
+    last complete data packet.  The stream has to have the same header and
+    FileProperties size, and the last kept packet has to come back
+    identical, otherwise the download starts over."""
+    result = dict(result='error', bytes=0, packets=0, expected_packets=0,
+            resumed_packets=0, error=None)
+    conn = None
+    try:
+        host, port, path = split_url(url)
+        client_guid = '{%s}' % str(uuid.uuid4()).upper()
+
+        conn, r = open_stream(host, port, path, client_guid, timeout)
+        if r.status == 404:
+            result.update(result='404', error='404 (Not Found)')
+            return result
+        if r.status != 200:
+            result['error'] = 'HTTP %d %s' % (r.status, r.reason)
+            return result
+        header, ctype, seq, body = read_header(r)
+        conn.close()
+        info = parse_header(header)
+        header = header[:info['header_len']]
+        result['expected_packets'] = info['packet_count']
+
+        record = dict(header=hashlib.sha1(header).hexdigest(),
+                file_size=info['file_size'], packet_size=info['packet_size'],
+                header_len=len(header), packets=0)
+        start = resume_point(fn, record) if resume else 0
+        if not start:
+            remove_progress(fn)
+
+        while True:
+            try:
+                ended = play(host, port, path, client_guid, timeout, info,
+                        fn, header, start, record, result, progress, resume,
+                        sink)
+                break
+            except Discontinuity:
+                # the server didn't continue where we left off
+                start = 0
+        if ended is None:
+            return result
+
+        if not ended or result['packets'] < result['expected_packets']:
+            result.update(result='truncated', error='got %d of %d packets' % (
+                result['packets'], result['expected_packets']))
+        else:
+            result['result'] = 'ok'
+            remove_progress(fn)
+    except socket.timeout, e:
+        result.update(result='timeout', error=str(e) or 'timed out')
+    except Truncated, e:
+        result.update(result='truncated', error=str(e))
+    except Cancelled:
+        result.update(result='cancelled', error='cancelled')
+    except (socket.error, httplib.HTTPException, ValueError), e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        if conn:
+            conn.close()
+    return result
+
+def play(host, port, path, client_guid, timeout, info, fn, header, start,
+        record, result, progress, resume, sink):
+    """Stream data packets into fn after its first start packets.  Returns
+    whether the end of the stream was seen, or None if the server refused
+    to play."""
+    packet_size = info['packet_size']
+    header_len = len(header)
+    if start:
+        f = file(fn, 'r+b')
+        f.truncate(header_len + start * packet_size)
+        # the last kept packet is asked for again to check continuity
+        offset = header_len + (start - 1) * packet_size
+        f.seek(offset)
+        anchor = f.read(packet_size)
+        if sink:
+            sink.reset()
+            f.seek(0)
+            left = header_len + start * packet_size
+            while left:
+                data = f.read(min(left, 2**20))
+                sink.update(data)
+                left -= len(data)
+        f.seek(0, 2)
+    else:
+        f = file(fn, 'wb')
+        f.write(header)
+        if sink:
+            sink.reset()
+            sink.update(header)
+        anchor = None
+        offset = None
+    result.update(packets=start, resumed_packets=start,
+            bytes=header_len + start * packet_size)
+    record['packets'] = start
+
+    conn, r = open_stream(host, port, path, client_guid, timeout,
+            info['stream_ids'], offset)
+    try:
+        if r.status != 200:
+            result['error'] = 'HTTP %d %s' % (r.status, r.reason)
+            return None
+        ended = False
+        # the play response repeats the header before the packets
+        h, ctype, seq, body = read_header(r)
+        while ctype is not None:
+            if ctype == CHUNK_DATA:
+                if len(body) > packet_size:
+                    raise ValueError('packet larger than packet size')
+                body += '\0' * (packet_size - len(body))
+                if anchor is not None:
+                    # a server honouring the offset starts at the last kept
+                    # packet, one ignoring it replays everything before it
+                    if body == anchor and seq in (0, start - 1):
+                        anchor = None
+                    elif seq >= start - 1:
+                        raise Discontinuity()
+                else:
+                    f.write(body)
+                    if sink:
+                        sink.update(body)
+                    result['packets'] += 1
+                    result['bytes'] += packet_size
+                    if resume and result['packets'] % 256 == 0:
+                        f.flush()
+                        record['packets'] = result['packets']
+                        save_progress(fn, record)
+                    if progress:
+                        progress(result)
+            elif ctype == CHUNK_END:
+                ended = True
+                break
+            elif ctype == CHUNK_RESET:
+                raise ValueError('stream changed')
+            ctype, seq, body = read_chunk(r)
+        if anchor is not None:
+            raise Discontinuity()
+        return ended
+    finally:
+        conn.close()
+        f.close()
+        if resume and result['packets'] > record['packets']:
+            record['packets'] = result['packets']
+            save_progress(fn, record)
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urllib.unquote(urlparse.urlsplit(self.path).path).lstrip('/')
+        if '..' in path:
+            self.send_error(404)
+            return
+        path = os.path.join(self.server.root, path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        data = file(path, 'rb').read()
+        info = parse_header(data)
+        header = data[:info['header_len']]
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-mms-framed')
+        self.end_headers()
+        for i in range(0, len(header), 32768):
+            self.wfile.write(pack_chunk(CHUNK_HEADER, 0, header[i:i+32768]))
+
+        pragma = ','.join(self.headers.getheaders('Pragma'))
+        if 'xPlayStrm=1' not in pragma:
+            return
+        size = info['packet_size']
+        first = 0
+        m = re.search(r'stream-offset=(\d+):(\d+)', pragma)
+        if m and m.group(1) != '4294967295':
+            offset = (int(m.group(1)) << 32) + int(m.group(2))
+            first = max(0, offset - info['header_len']) // size
+        for seq in range(first, info['packet_count']):
+            if seq - first == self.server.truncate_after:
+                return
+            pos = info['header_len'] + seq * size
+            self.wfile.write(pack_chunk(CHUNK_DATA, seq, data[pos:pos+size]))
+        self.wfile.write(pack_chunk(CHUNK_END, 0))
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the ASF files under root over MMSH, honouring stream-offset.
+    With truncate_after set, every stream is cut off after that many data
+    packets."""
+    daemon_threads = True
+
+    def __init__(self, root, port=0, truncate_after=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                StandInHandler)
+        self.root = root
+        self.truncate_after = truncate_after
+
+def main():
+    if sys.argv[1:2] == ['serve'] and len(sys.argv) in (3, 4):
+        port = int(sys.argv[3]) if len(sys.argv) == 4 else 8000
+        StandInServer(sys.argv[2], port).serve_forever()
+    elif sys.argv[1:2] == ['download'] and len(sys.argv) == 4:
+        def progress(result):
+            if result['packets'] % 1000 == 0:
+                print '%(packets)d/%(expected_packets)d packets' % result
+        print download(sys.argv[2], sys.argv[3], progress)
+    else:
+        print 'Usage: %s serve <dir> [port]' % sys.argv[0]
+        print '       %s download <url> <file>' % sys.argv[0]
+
+if __name__ == '__main__':
+    main()
@@ -2,55 +2,209 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+if '--gevent' in sys.argv:
+    # patch before anything below creates sockets, threads or locks; handlers
+    # then run as greenlets and psycopg2 waits on the gevent hub
+    from gevent import monkey
+    monkey.patch_all()
+    import psycogreen.gevent
+    psycogreen.gevent.patch_psycopg()
 import re
 import time
+import math
 import cgi
 import sqlite3
 import random
 import json
 import collections
 import threading
+import hashlib
 import datetime
+import traceback
 
 import cherrypy
 from cherrypy.lib.static import serve_file
 from cherrypy.lib import cptools, httputil
 
-from ivod_db import DB
+import ivod_db
+from ivod_db import DB, MAX_404
 
 def error_page(status, message, traceback, version):
     return status + ' ' + message
 
-class IVOD:
-    @cherrypy.expose
-    def index(self, *args):
+pool = ivod_db.Pool(maxconn=10)
+
+def get_db():
+    """Check out a pooled connection for the current request.  It goes back
+    to the pool when the request ends, whichever way the handler returns."""
+    db = getattr(cherrypy.request, 'db', None)
+    if db is None:
+        if not getattr(cherrypy.request, 'db_hooked', False):
+            cherrypy.request.hooks.attach('on_end_request', release_db)
+            cherrypy.request.db_hooked = True
+        db = cherrypy.request.db = DB(pool=pool)
+    return db
+
+def release_db():
+    """Return the request's connection early, e.g. before blocking."""
+    db = getattr(cherrypy.request, 'db', None)
+    if db is not None:
+        db.close()
+        cherrypy.request.db = None
+
+# wakes long-polling /next requests when a new job is added
+listener = ivod_db.Listener()
+listener.start()
+
+# seconds between folding status counter deltas into the summary
+FOLD_INTERVAL = 60
+
+def fold_status():
+    while True:
+        time.sleep(FOLD_INTERVAL)
+        db = None
+        try:
+            db = DB(pool=pool)
+            db.fold_status_deltas()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if db is not None:
+                db.close()
+
+fold_thread = threading.Thread(target=fold_status)
+fold_thread.daemon = True
+fold_thread.start()
+
+# max jobs leased by a single next_batch
+MAX_BATCH = 20
+
+# states a client may report through /change and /change_batch; 'released'
+# gives a leased job back unattempted
+CLIENT_STATES = ('404', 'downloaded', 'failed', 'released')
+
+# states a reported result can't change any more
+FINISHED_STATES = ('downloaded', 'stored')
+
+# max seconds a /next request may block waiting for a job
+MAX_WAIT = 300
+
+# min seconds between claim attempts of a blocked request
+MIN_POLL = 10
+
+# only long-poll where a waiting request is a cheap greenlet; the threaded
+# servers have a handful of worker threads, which waiting clients would take
+# away from /change and /next_batch
+LONG_POLL = '--gevent' in sys.argv
+
+# (time, result) of the last too_busy count
+busy_cache = (0, False)
+BUSY_TTL = 30
+
+def too_busy(db):
+    """Don't hand out more work during office hours when many downloads are
+    already running."""
+    global busy_cache
+    now = datetime.datetime.now()
+    if not (0 <= now.weekday() <= 4 and 6 <= now.hour <= 19):
+        return False
+    t, busy = busy_cache
+    if time.time() - t < BUSY_TTL:
+        return busy
+    result = db.query('''
+    SELECT count(*)
+    FROM download_state
+    WHERE state = 'downloading' AND last_modified > now() - interval '24 hours'
+    ''')
+    busy = bool(result and int(result[0][0]) > 10)
+    busy_cache = (time.time(), busy)
+    return busy
+
+def claim(name, bw, n, wait=0, claim_id=None):
+    """Claim up to n jobs for name, see DB.claim_jobs.  With wait > 0 and --gevent, block up to
+    wait seconds for one to become eligible instead of answering 'done'
+    right away.  Returns a list of jobs, 'done' or 'wait'.
+
+    'wait' is always answered at once; clients back off for a long while on
+    it by themselves.  A blocked request holds no database connection.
+    """
+    if not LONG_POLL:
+        wait = 0
+    deadline = time.time() + min(wait, MAX_WAIT)
+    while True:
+        seq = listener.seq
+        db = get_db()
+        if too_busy(db):
+            return 'wait'
+        jobs = db.claim_jobs(name, bw, n, claim_id)
+        if jobs:
+            return jobs
+
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            return 'done'
+        # failed and 404 jobs become eligible without any notification; a
+        # job that is due already is locked by a concurrent claim
+        delay = db.seconds_to_eligible(bw)
+        if delay is not None:
+            timeout = min(timeout, max(delay, MIN_POLL))
+        release_db()
+        listener.wait(seq, timeout)
+
+# compiled template.mako
+index_template = None
+
+# rendered index page: (listener seq, time, etag, html)
+index_cache = None
+
+# re-check the counts at least this often; notifications only come for new
+# jobs, not for every state change
+INDEX_TTL = 60
+
+def render_index(rows):
+    global index_template
+    if index_template is None:
         from mako.template import Template
-        tmpl = Template(filename='template.mako', output_encoding='utf-8')
-        data = {}
-        cd = collections.defaultdict
+        index_template = Template(filename='template.mako', output_encoding='utf-8')
 
+    data = {}
+    cd = collections.defaultdict
+    data['status'] = cd(lambda: cd(lambda: cd(lambda: cd(int))))
+    for year, clip, bw, state, count in rows:
+        state = {
+                'no': u'未下載',
+                '404': u'404 not found (to try)',
+                '404skip': u'404 not found',
+                'downloading': u'下載中',
+                'downloaded': u'已下載(a)',
+                'stored': u'已下載(b)',
+                }.get(state, u'其他')
+        data['status'][year][clip][bw][state] = count
 
-        data['status'] = cd(lambda: cd(lambda: cd(lambda: cd(int))))
+    return index_template.render(**data)
 
-        db = DB()
-        rows = db.get_status()
-        db.close()
-        for year, clip, bw, state, count in rows:
-            print year, clip, bw, state, count
-            state = {
-                    'no': u'未下載',
-                    '404': u'404 not found (to try)',
-                    '404skip': u'404 not found',
-                    'downloading': u'下載中',
-                    'downloaded': u'已下載(a)',
-                    'stored': u'已下載(b)',
-                    }.get(state, u'其他')
-            data['status'][year][clip][bw][state] = count
-
-        print data
-
-        result = tmpl.render(**data)
-        return result
+class IVOD:
+    @cherrypy.expose
+    def index(self, *args):
+        global index_cache
+        # read seq before the query, so a change racing with it forces a
+        # refresh next time
+        seq = listener.seq
+        cache = index_cache
+        if not cache or cache[0] != seq or time.time() - cache[1] > INDEX_TTL:
+            rows = sorted(get_db().get_status())
+            etag = '"%s"' % hashlib.sha1(repr(rows)).hexdigest()
+            if cache and cache[2] == etag:
+                html = cache[3]
+            else:
+                html = render_index(rows)
+            cache = index_cache = (seq, time.time(), etag, html)
+
+        seq, t, etag, html = cache
+        cherrypy.response.headers['ETag'] = etag
+        # answers 304 if If-None-Match matches
+        cptools.validate_etags()
+        return html
         #return serve_file(os.path.join(current_dir, 'static', 'index.html'))
 
     @cherrypy.expose
@@ -63,21 +217,19 @@ class IVOD:
         if not re.match(pattern, name) or not re.match(pattern, contact):
             return json.dumps(dict(result='error', msg='valid pattern: %s' % pattern))
 
-        db = DB()
+        db = get_db()
         if db.get_user_token(name):
             return json.dumps(dict(result='error', msg='user exists'))
         assert name and contact
         token = str(random.getrandbits(32))
         db.add_user_token(name, contact, token)
-        db.close()
         return json.dumps(dict(result='ok', token=token))
 
     @cherrypy.expose
     def metadata(self, vid):
-        db = DB()
+        db = get_db()
         cherrypy.response.headers['Content-Type'] = 'application/json; charset=utf-8'
         data = db.get_metadata(vid)
-        db.close()
         return data
 
     
@@ -86,119 +238,156 @@ class IVOD:
         bw = argd.get('bw')
         name = argd.get('name')
         token = argd.get('token')
+        try:
+            wait = float(argd.get('wait', 0))
+        except ValueError:
+            return 'invalid'
+        if not name or not token:
+            return 'Empty name or token'
+        db = get_db()
+        if db.get_user_token(name) != token:
+            return json.dumps('invalid token')
+
+        jobs = claim(name, bw, 1, wait, argd.get('claim'))
+        if jobs in ('done', 'wait'):
+            return jobs
+
+        key, videodate, lease = jobs[0]
+        return json.dumps((str(videodate).replace('-','/'), key))
+
+    @cherrypy.expose
+    def next_batch(self, *args, **argd):
+        bw = argd.get('bw')
+        name = argd.get('name')
+        token = argd.get('token')
+        try:
+            n = min(int(argd.get('n', 1)), MAX_BATCH)
+            wait = float(argd.get('wait', 0))
+        except ValueError:
+            return 'invalid'
         if not name or not token:
             return 'Empty name or token'
-        db = DB()
+        db = get_db()
         if db.get_user_token(name) != token:
             return json.dumps('invalid token')
 
-        now = datetime.datetime.now()
-        if 0 <= now.weekday() <= 4 and 6 <= now.hour <= 19:
-            result = db.query('''
-            SELECT count(*)
-            FROM download_state
-            WHERE state = 'downloading' AND last_modified > now() - interval '24 hours'
-            ''')
-            if result and int(result[0][0]) > 10:
-                return 'wait'
-
-        # bw, clip
-        # 0, 0  200KB/s
-        # 0, 1  500KB/s
-        # 1, 0  70KB/s
-        # 1, 1  70KB/s
-        if bw == 'high':
-            bw_cond = 'true'
-        elif bw == 'mid':
-            # bw, clip != 0, 1
-            bw_cond = '(bw = 1 OR clip = 0)'
-        elif bw == 'low':
-            # bw = 1
-            bw_cond = '(bw = 1)'
-        else:
-            bw_cond = 'true'
-
-        while True:
-            t0 = time.time()
-            result = db.query('''
-                    SELECT key, videodate, last_modified, state
-                    FROM download_state 
-                    WHERE (
-                        (state = 'no')
-                        OR (state = 'downloading' AND clip = 1 AND last_modified < now() - interval '12 hours')
-                        OR (state = 'downloading' AND clip = 0 AND last_modified < now() - interval '24 hours')
-                        OR (state = 'failed' AND last_modified < now() - interval '10 minutes')
-                        OR (state = '404' AND last_modified < now() - interval '10 minutes')
-                        ) AND state != '404skip' AND %s
-
-                    ORDER BY last_modified
-                    LIMIT 1
-                    FOR UPDATE
-                    ''' % bw_cond,
-                    )
-            print 't', time.time() - t0
-
-            if not result or not result[0][0]:
-                return 'done'
-
-            row = result[0]
-            key, videodate, last_modified, state = row
-
-            if state == '404':
-                result = db.query('''
-                SELECT count(*)
-                FROM download_state_history
-                WHERE key = %s AND state = '404'
-                ''', key)
-                if int(result[0][0]) >= 10:
-                    with db.conn:
-                        db.change_job_state(key, name, '404skip')
-                    continue
-
-            with db.conn:
-                db.change_job_state(key, name, 'downloading')
-            db.close()
-            return json.dumps((str(videodate).replace('-','/'), key))
+        jobs = claim(name, bw, max(n, 1), wait, argd.get('claim'))
+        if jobs in ('done', 'wait'):
+            return jobs
+
+        # each job is leased until its downloading state goes stale
+        return json.dumps([
+            (str(videodate).replace('-','/'), key, lease.days * 86400 + lease.seconds)
+            for key, videodate, lease in jobs])
+
+    def _parse_result(self, key, state, info=None, rate=None):
+        """Check one reported result before anything is written.  Returns
+        the arguments for _change; malformed input is a 400."""
+        try:
+            date, url = json.loads(key)
+        except (TypeError, ValueError):
+            raise cherrypy.HTTPError(400, 'invalid key')
+        if state not in CLIENT_STATES:
+            raise cherrypy.HTTPError(400, 'invalid state')
+        if rate is not None:
+            try:
+                rate = float(rate)
+            except (TypeError, ValueError):
+                raise cherrypy.HTTPError(400, 'invalid rate')
+            if math.isnan(rate) or math.isinf(rate) or rate < 0:
+                raise cherrypy.HTTPError(400, 'invalid rate')
+        return url, state, info, rate
+
+    def _change(self, db, name, url, state, info, rate=None):
+        if state == 'downloaded' and not info:
+            return 'invalid'
+
+        # clients resend results from their journal until they see an
+        # answer, so the same result can arrive twice; a repeat is answered
+        # 'ok' without undoing or duplicating what the first one did
+        current = db.lock_job_state(url)
+        if current:
+            old_state, owner = current
+            if old_state in FINISHED_STATES:
+                return 'ok'
+            # failures only count while the reporter still holds the lease
+            if state != 'downloaded' and (old_state != 'downloading' or owner != name):
+                return 'ok'
+
+        if state == 'released':
+            db.release_job(url)
+            return 'ok'
+        db.change_job_state(url, name, state, rate)
+        if info:
+            db.add_video_info(url, name, info)
+        if state == '404':
+            if db.count_404(url) >= MAX_404:
+                db.change_job_state(url, name, '404skip')
+        return 'ok'
 
     @cherrypy.expose
     def change(self, *args, **argd):
         key = argd.get('key')
-        date, url = json.loads(key)
         state = argd.get('state')
         info = argd.get('info')
+        rate = argd.get('rate')
         name = argd.get('name')
         token = argd.get('token')
-        db = DB()
+        if not name or not token:
+            return 'Empty name or token'
+        db = get_db()
         if db.get_user_token(name) != token:
             return 'invalid token'
-        if state == 'downloaded' and not info:
-            return 'invalid'
 
-        assert state in ('404', 'downloaded', 'failed')
+        result = self._parse_result(key, state, info, rate)
         with db.conn:
-            db.change_job_state(url, name, state)
-            if info:
-                db.add_video_info(url, name, info)
-            if state == '404':
-                result = db.query('''
-                SELECT count(*)
-                FROM download_state_history
-                WHERE key = %s AND state = '404'
-                ''', url)
-                if int(result[0][0]) >= 10:
-                    db.change_job_state(url, name, '404skip')
-        db.close()
-        return 'ok'
+            result = self._change(db, name, *result)
+        return result
+
+    @cherrypy.expose
+    def change_batch(self, *args, **argd):
+        """Report many results at once; results is a JSON list of
+        [key, state, info] or [key, state, info, rate].  Returns a JSON list
+        of per-result answers."""
+        name = argd.get('name')
+        token = argd.get('token')
+        if not name or not token:
+            return 'Empty name or token'
+        db = get_db()
+        if db.get_user_token(name) != token:
+            return 'invalid token'
+
+        # reject the whole batch before writing any of it
+        try:
+            results = json.loads(argd.get('results', '[]'))
+            results = [self._parse_result(*result) for result in results]
+        except (TypeError, ValueError):
+            raise cherrypy.HTTPError(400, 'invalid results')
+
+        answers = []
+        with db.conn:
+            for result in results:
+                answers.append(self._change(db, name, *result))
+        return json.dumps(answers)
 
     @cherrypy.expose
     def status(self):
-        db = DB()
+        db = get_db()
         rows = db.get_status()
-        db.close()
         return json.dumps(rows)
 
+    @cherrypy.expose
+    def stats(self):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(dict(pool=pool.stats(),
+            token_cache=ivod_db.token_cache.stats()))
+
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
+PORT = 8080
+if '--port' in sys.argv:
+    PORT = int(sys.argv[sys.argv.index('--port') + 1])
+
 if '--fastcgi' in sys.argv:
     app = cherrypy.tree.mount(IVOD())
     cherrypy.config.update({'engine.autoreload_on':False})
@@ -211,6 +400,19 @@ if '--fastcgi' in sys.argv:
     from flup.server.fcgi import WSGIServer
     WSGIServer(app).run()
 
+elif '--gevent' in sys.argv:
+    # one greenlet per client connection, so idle and waiting clients are
+    # cheap; the pool still bounds concurrent queries
+    app = cherrypy.tree.mount(IVOD())
+    cherrypy.config.update({'engine.autoreload_on':False})
+    cherrypy.config.update({
+        'log.screen': False,
+        })
+    cherrypy.config.update({'error_page.default':error_page})
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(('192.168.0.254', PORT), app, log=None).serve_forever()
+
 else:
-    cherrypy.config.update({'server.socket_host': '192.168.0.254'})
+    cherrypy.config.update({'server.socket_host': '192.168.0.254',
+        'server.socket_port': PORT})
     cherrypy.quickstart(IVOD())
@@ -0,0 +1,37 @@
+#!/usr/local/bin/python
+# Check download_status_summary against download_state.
+#
+#   python status_summary.py            # report differences
+#   python status_summary.py rebuild    # recount from scratch, then check
+#   python status_summary.py fold       # fold pending deltas into the summary
+#
+# server.py folds the deltas every minute by itself.
+import sys
+
+import ivod_db
+
+db = ivod_db.DB()
+
+def check():
+    diff = db.diff_status_summary()
+    for year, clip, bw, state, expected, actual in diff:
+        print 'year=%s clip=%s bw=%s state=%s: expected %d, got %d' % (
+                year, clip, bw, state, expected, actual)
+    return not diff
+
+def main():
+    if sys.argv[1:] == ['rebuild']:
+        db.rebuild_status_summary()
+    elif sys.argv[1:] == ['fold']:
+        print '%d deltas folded' % db.fold_status_deltas()
+    elif sys.argv[1:]:
+        print 'Usage: %s [rebuild|fold]' % sys.argv[0]
+        sys.exit(2)
+
+    if check():
+        print 'ok'
+    else:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
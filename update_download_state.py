@@ -4,10 +4,16 @@ import time
 import os
 import re
 import sys
+from optparse import OptionParser
 
 import ivod_db
 import util
 
+parser = OptionParser()
+parser.add_option('--checksum_io', default=None,
+        help='checksum read pacing, e.g. fixed, none, mbps=40, iops=80, '
+        'latency=0.05 (default)')
+
 db = ivod_db.DB()
 
 g_user = ''
@@ -88,6 +94,10 @@ def gen_job():
 
 def main():
     global g_user, g_token
+
+    options, args = parser.parse_args()
+    if options.checksum_io:
+        util.checksum_pacer = util.parse_pacer(options.checksum_io)
     
     with file(token_file) as f:
         g_user = f.readline().strip()
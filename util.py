@@ -1,13 +1,21 @@
 import os
 import re
 import sys
+import struct
 import hashlib
 import urllib
 import json
 import time
+import threading
 
 import wmv
 
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
 def fix_mms(v):
     v = ''.join([c if ord(c) < 0x80 else '%%%02x'%ord(c) for c in v.encode('utf8')])
     return v
@@ -33,18 +41,138 @@ def extract_mms_link_from_vodeo_page(html):
         return mms
     return None
 
-def calc_checksum(fn):
-    # sha512 is faster than sha256
-    alg = 'sha512'
+# sha512 is faster than sha256
+CHECKSUM_ALG = 'sha512'
+
+# give up on collecting a header larger than this
+MAX_HEADER_LEN = 2**24
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+def load_fadvise():
+    # python 2 has no os.posix_fadvise
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        f = libc.posix_fadvise64
+    except (OSError, AttributeError):
+        return None
+    f.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    return f
+
+_fadvise = load_fadvise()
+
+def fadvise(f, advice, offset=0, length=0):
+    if _fadvise:
+        _fadvise(f.fileno(), offset, length, advice)
+
+class IOPacer(object):
+    """Read size and pauses for background reads, so hashing the archive
+    leaves the disks usable.  At most one of
+      delay    seconds to sleep after every read
+      mbps     MB/s budget; with iops too, the read size is mbps / iops
+      iops     reads per second budget
+      latency  target seconds per read.  Reads getting slower than that
+               means the device is busy, and pauses grow accordingly.
+    With none of them reads go as fast as the device allows.
+
+    The budgets are for the process: files hashed at once through the same
+    pacer share them, each read taking its turn."""
+
+    # longest pause in latency mode
+    max_delay = 1.0
+    # seconds of unused budget that may be caught up on after a pause
+    slack = 1.0
+
+    def __init__(self, block_size=2**20, delay=None, mbps=None, iops=None,
+            latency=None):
+        if mbps and iops:
+            block_size = max(4096, int(mbps * 2**20 / iops))
+            iops = None
+        self.block_size = block_size
+        self.delay = delay
+        self.mbps = mbps
+        self.iops = iops
+        self.latency = latency
+        # time up to which the mbps or iops budget is spent
+        self.spent = time.time()
+        self.avg_latency = None
+        self.nbytes = 0
+        self.nreads = 0
+        self.lock = threading.Lock()
+
+    def wait(self, nbytes, read_time):
+        """Called after each read of nbytes that took read_time seconds."""
+        d = 0
+        with self.lock:
+            now = time.time()
+            self.nbytes += nbytes
+            self.nreads += 1
+            if self.delay:
+                d = self.delay
+            elif self.mbps or self.iops:
+                self.spent = max(self.spent, now - self.slack)
+                if self.mbps:
+                    self.spent += nbytes / (self.mbps * 2**20)
+                else:
+                    self.spent += 1.0 / self.iops
+                d = self.spent - now
+            elif self.latency:
+                if self.avg_latency is None:
+                    self.avg_latency = read_time
+                else:
+                    self.avg_latency = self.avg_latency * 0.8 + read_time * 0.2
+                # twice the target latency gives a 50% duty cycle and so on
+                d = min(self.max_delay,
+                        self.avg_latency * (self.avg_latency / self.latency - 1))
+        if d > 0:
+            time.sleep(d)
+
+    def __repr__(self):
+        return 'IOPacer(block_size=%d, delay=%r, mbps=%r, iops=%r, latency=%r)' % (
+                self.block_size, self.delay, self.mbps, self.iops, self.latency)
+
+def parse_pacer(spec):
+    """'fixed' for the old 64 KiB reads with 2 ms pauses, 'none', or
+    comma separated IOPacer arguments such as 'mbps=40', 'mbps=40,iops=80'
+    or 'latency=0.05,block_size=262144'."""
+    if spec == 'fixed':
+        return IOPacer(block_size=2**16, delay=0.002)
+    if spec == 'none':
+        return IOPacer()
+    argd = {}
+    for item in spec.split(','):
+        k, v = item.split('=')
+        if k not in ('block_size', 'delay', 'mbps', 'iops', 'latency'):
+            raise ValueError('unknown pacer setting: %s' % k)
+        argd[k] = int(v) if k == 'block_size' else float(v)
+    return IOPacer(**argd)
+
+# used by calc_checksum unless given another one
+checksum_pacer = IOPacer(latency=0.05)
+
+def calc_checksum(fn, pacer=None):
+    if pacer is None:
+        pacer = checksum_pacer
+    alg = CHECKSUM_ALG
     h = hashlib.new(alg)
+    buf = bytearray(pacer.block_size)
+    view = memoryview(buf)
     with file(fn, 'rb') as f:
+        fadvise(f, POSIX_FADV_SEQUENTIAL)
+        pos = 0
         while True:
-            # don't make disks too busy
-            b = f.read(2**16)
-            time.sleep(0.002)
-            if not b:
+            t = time.time()
+            n = f.readinto(buf)
+            if not n:
                 break
-            h.update(b)
+            h.update(view[:n])
+            # don't push more useful pages out of the cache
+            fadvise(f, POSIX_FADV_DONTNEED, pos, n)
+            pos += n
+            pacer.wait(n, time.time() - t)
     hd = h.hexdigest()
     return alg + ':' + hd
 
@@ -59,6 +187,45 @@ def collect_video_info(fn):
     print d
     return d
 
+class VideoInfoCollector(object):
+    """Fed with every byte written to a file, info() gives what
+    collect_video_info would return for it, without reading it back."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.checksum = hashlib.new(CHECKSUM_ALG)
+        self.size = 0
+        self.header = ''
+        # the 24 byte object header tells the size of the whole header
+        self.header_len = 24
+        self.sized = False
+
+    def update(self, data):
+        self.checksum.update(data)
+        self.size += len(data)
+        pos = 0
+        while len(self.header) < self.header_len and pos < len(data):
+            n = self.header_len - len(self.header)
+            self.header += data[pos:pos+n]
+            pos += n
+            if not self.sized and len(self.header) == 24:
+                self.sized = True
+                size, = struct.unpack_from('<Q', self.header, 16)
+                self.header_len = max(24, min(size, MAX_HEADER_LEN))
+
+    def info(self):
+        d = None
+        if self.sized and len(self.header) == self.header_len:
+            d = wmv.extract_metadata_from_header(self.header)
+        if not d:
+            d = {}
+        d['checksum'] = CHECKSUM_ALG + ':' + self.checksum.hexdigest()
+        d['filesize'] = self.size
+        print d
+        return d
+
 def main():
     import requests
     url = sys.argv[1]
@@ -26,22 +26,48 @@
 # Python built-in modules
 import sys
 import os
+import threading
 
 # Project modules
 import videofile
 import streams
 
-__all__ = ['VideoParser']
+__all__ = ['VideoParser', 'parse_file', 'register_plugin']
 __author__ = "Michael van Tellingen <michaelvantellingen at gmail.com>"
 
 from videoparser.version import version as __version__
 
 # List of plugins
-parser_plugins = ['asf', 'matroska', 'avi', 'realmedia', 'quicktime']
+parser_plugins = []
+
+# Plugin name -> (file types, [(offset, signature)])
+plugin_signatures = {}
+
+def register_plugin(name, file_types, magic):
+    """ Register the plugin module videoparser.plugins.<name>, which handles
+        files with the given extensions and starting with one of the
+        (offset, signature) pairs in magic.  The module is only imported
+        when a file matching it is parsed. """
+    if name not in parser_plugins:
+        parser_plugins.append(name)
+    plugin_signatures[name] = (list(file_types), list(magic))
+
+register_plugin('asf', ['wmv'],
+        [(0, '\x30\x26\xb2\x75\x8e\x66\xcf\x11\xa6\xd9\x00\xaa\x00\x62\xce\x6c')])
+register_plugin('matroska', ['mkv'], [(0, '\x1a\x45\xdf\xa3')])
+register_plugin('avi', ['avi'], [(0, 'RIFF')])
+register_plugin('realmedia', ['rm'], [(0, '.RMF')])
+register_plugin('quicktime', ['mov', 'mp4'],
+        [(0, '\x00\x00\x00 ftypqt  '), (4, 'moov')])
+
 
 class VideoParser(object):
-    """ The VideoParser object will first guess the required parser based on
-        the file extension. If that fails it will try each available parser.
+    """ The VideoParser object reads the first bytes of the file and hands it
+        to the parser whose signature matches, preferring the one for the
+        file extension if several do.
+        
+        Plugins are imported on first use.  A VideoParser may be shared
+        between threads, each thread gets its own plugin objects.
         
         On success it will return the videofile.VideoFile object
     
@@ -55,61 +81,69 @@ class VideoParser(object):
 
     def __init__(self):
         """ Initialise the VideoParser object."""
-        self.parsers = []
-        self._import_parsers()
+        self._modules = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    
+    def _import_parser(self, name):
+        """ Import the plugin module for name, once. """
+        module = self._modules.get(name)
+        if module is None:
+            with self._lock:
+                module = self._modules.get(name)
+                if module is None:
+                    module = __import__("videoparser.plugins." + name,
+                                        None, None, "plugins")
+                    self._modules[name] = module
+        return module
     
-    def _import_parsers(self):
-        """ Import the specified parsers in the global list parser_plugins. """
-        # Import the parsers
-        for plugin_filename in parser_plugins:
-            try:
-                module = __import__("videoparser.plugins." + plugin_filename,
-                                    None, None, "plugins")
-            except ImportError, err:
-                raise
-                print "Unable to open parser module '%s'" % plugin_filename 
-                continue
+    def get_parser(self, name):
+        """ The parser object of the plugin name for the current thread. """
+        parsers = getattr(self._local, 'parsers', None)
+        if parsers is None:
+            parsers = self._local.parsers = {}
+        parser = parsers.get(name)
+        if parser is None:
+            parser = parsers[name] = self._import_parser(name).Parser()
+        return parser
+    
+    def _sniff_size(self):
+        return max(offset + len(signature)
+                   for file_types, magic in plugin_signatures.values()
+                   for offset, signature in magic)
+    
+    def guess_plugins(self, filename, head):
+        """ Names of the plugins whose signature matches head, the start of
+            the file, the one for the file extension first. """
+        filetype = os.path.splitext(filename)[1][1:].lower()
         
-            # Create parser object
-            try:
-                parser = module.Parser()
-            except AttributeError, err:
-                print "Invalid parser plugin: %s" % err
-                continue
-            
-            self.parsers.append(parser)
-
+        candidates = []
+        for name in parser_plugins:
+            file_types, magic = plugin_signatures[name]
+            for offset, signature in magic:
+                if head[offset:offset+len(signature)] == signature:
+                    if filetype in file_types:
+                        candidates.insert(0, name)
+                    else:
+                        candidates.append(name)
+                    break
+        return candidates
     
     def parse_file(self, filename):
         """ Parse the given file and return a videofile.VideoFile object on
             success or None when there was a parsing error or no matching
             parser was found. """
-            
-        video = videofile.VideoFile()
         
-
-        filetype = filename[filename.rindex(os.extsep)+1:]
-        # Guess on the extension which parser to use
-        for parser in self.parsers:
-            if filetype in parser._file_types:
-                break
-            parser = None
-        
-        guessed_parser = parser
-        if guessed_parser and self._parse_file_with(filename, parser, video):
-            return video
+        try:
+            with open(filename, 'rb') as f:
+                head = f.read(self._sniff_size())
+        except IOError:
+            print "IOError on file '%s'"  % filename
+            return None
         
-        # Don't try other parsers
-        #return None
-    
-        # Try all parsers then
-        for parser in self.parsers:
-            
-            # Don't parse the file twice with the same parser
-            if parser == guessed_parser:
-                continue
-            
-            if self._parse_file_with(filename, parser, video):
+        for name in self.guess_plugins(filename, head):
+            video = videofile.VideoFile()
+            if self._parse_file_with(filename, self.get_parser(name), video):
                 return video
     
         return None
@@ -133,7 +167,15 @@ class VideoParser(object):
             print "Error parsing '%s'" % filename
             raise
 
+
+# Parser shared by everything in the process
+shared_parser = VideoParser()
+
+def parse_file(filename):
+    """ Parse filename with the shared VideoParser. """
+    return shared_parser.parse_file(filename)
+
+
 if __name__ == "__main__":
-    video_parser = VideoParser()
     for filename in sys.argv[1:]:
-        print repr(video_parser.parse_file(filename))
+        print repr(parse_file(filename))
@@ -31,6 +31,8 @@ class BaseParser(object):
 
 
 class Structure(object):
+    __slots__ = ['id', '_values', '_keys']
+    
     _formatting = {types.bytes:     r'%r',
                    types.stream:    r'%r',
                    types.float:     r'%f',
@@ -47,7 +49,7 @@ class Structure(object):
     def set(self, key, value, type=types.bytes, description=''):
         
         # This should become a warning
-        if key in self._keys:
+        if key in self._values:
             raise AssertionError("Duplicate key in structure")
         
         self._keys.append(key)
@@ -55,8 +57,13 @@ class Structure(object):
     
 
     def __getattr__(self, key):
-        if key in self._keys:
-            return self._values[key][0]
+        # Only called for keys that aren't slots; an unset slot (say on a
+        # half constructed copy) must not recurse through _values
+        if key[0] != '_':
+            try:
+                return self._values[key][0]
+            except KeyError:
+                pass
         
         raise AttributeError("Attribute '%s' not found." % key)
     
@@ -60,6 +60,9 @@ guid_list = {
     '1806D474-CADF-4509-A4BA-9AABCB96AAE8': 'ASF_Padding_Object',
 }
 
+# guid_list by raw guid bytes, for stream.read_guid_bytes()
+guid_table = streams.binary.guid_table(guid_list)
+
 
 
 
@@ -75,9 +78,9 @@ class Parser(plugins.BaseParser):
         stream = streams.factory.create_filestream(filename,
                                                    endianess=self._endianess)
             
-        object_id   = stream.read_guid()
+        object_id   = stream.read_guid_bytes()
         
-        if guid_list.get(object_id) != 'ASF_Header_Object':
+        if guid_table.get(object_id) != 'ASF_Header_Object':
             return False
 
         try:                    
@@ -144,7 +147,11 @@ class Parser(plugins.BaseParser):
         return video
     
     
-    def parse_header(self, stream):
+    def parse_header(self, stream, object_types=None):
+        """ Parse the header object at the current position of stream.  With
+            object_types, only objects (and header extension objects) of
+            those types are parsed, the others are skipped by size and left
+            out of the result. """
         
         # Read the header information
         header = self.Header()
@@ -160,16 +167,21 @@ class Parser(plugins.BaseParser):
         
         # Loop through all objects contained in the header
         for i in range(0, header.num_objects):
-            guid = stream.read_guid()
+            guid = stream.read_guid_bytes()
             size = stream.read_uint64()
             
             obj = None
             
             try:
-                object_type = guid_list[guid]
+                object_type = guid_table[guid]
             except:
                 # Unrecognized object, skip over it
-                raise AssertionError("Unregognized object: %s" % guid)
+                raise AssertionError("Unregognized object: %s" %
+                    streams.binary.format_guid(guid))
+                stream.skip(size - 24)
+                continue
+            
+            if object_types is not None and object_type not in object_types:
                 stream.skip(size - 24)
                 continue
             
@@ -185,7 +197,7 @@ class Parser(plugins.BaseParser):
                 obj = self.parse_file_properties(data)
                 
             elif object_type == 'ASF_Header_Extension_Object':
-                obj = self.parse_header_extension(data)
+                obj = self.parse_header_extension(data, object_types)
                 
             elif object_type == 'ASF_Codec_List_Object':
                 obj = self.parse_codec_list(data)
@@ -235,8 +247,8 @@ class Parser(plugins.BaseParser):
     def parse_stream_properties(self, data):
         stream = self.StreamProperties()
         
-        stream.type = guid_list[data.read_guid()]
-        stream.ecc_type    = guid_list[data.read_guid()]
+        stream.type = guid_table[data.read_guid_bytes()]
+        stream.ecc_type    = guid_table[data.read_guid_bytes()]
         stream.time_offset = data.read_uint64()
         stream.type_length = data.read_uint32()
         stream.ecc_length  = data.read_uint32()
@@ -268,7 +280,7 @@ class Parser(plugins.BaseParser):
         return stream
         
     # mandatory, one only
-    def parse_header_extension(self, data):
+    def parse_header_extension(self, data, object_types=None):
         header = self.HeaderExtension()
         header.reserved_1 = data.read_guid()   # should be ASF_Reserved_1
         header.reserved_2 = data.read_uint16() # should be 6
@@ -278,17 +290,22 @@ class Parser(plugins.BaseParser):
         # Check reserved_1
         bytes = header.size
         while bytes > 0:
-            object_id = data.read_guid()
+            object_id = data.read_guid_bytes()
             object_size = data.read_uint64()
             bytes -= object_size
             
             if object_size == 0:
                 continue
         
+            object_type = guid_table.get(object_id)
+            if object_types is not None and object_type not in object_types:
+                data.skip(object_size - 24)
+                continue
+            
             sub_data = data.read_subsegment(object_size - 24)
             
             try:
-                object_type = guid_list[object_id]
+                object_type = guid_table[object_id]
             except KeyError:
                 # Skip unknown guid's, since authors are allowed to create
                 # there own
@@ -424,6 +441,8 @@ class Parser(plugins.BaseParser):
     # Objects to represent internal structure of the ASF File for debuging
     #
     class Structure(object):
+        __slots__ = ()
+        
         def repr_childs(self, obj):
             buffer = ""
             for entry in obj:
@@ -476,7 +495,7 @@ class Parser(plugins.BaseParser):
             return buffer
     
     class FileProperties(Structure):
-        __slots__ = ['id', 'size', 'create_data', 'packet_count',
+        __slots__ = ['id', 'size', 'create_date', 'packet_count',
                      'play_duration', 'send_duration', 'preroll',
                      'broadcast_flag', 'seekable_flag', 'reserved',
                      'min_packet_size', 'max_packet_size', 'max_bitrate']
@@ -504,6 +523,8 @@ class Parser(plugins.BaseParser):
     
     
     class HeaderExtension(Structure):
+        __slots__ = ['reserved_1', 'reserved_2', 'size', 'extension_data']
+        
         def __repr__(self):
             buffer  = "HeaderExtension Structure: \n"
             buffer += " %-30s: %s\n" % ('Reserved_1', self.reserved_1)
@@ -48,6 +48,9 @@ class Parser(plugins.BaseParser):
         self._last_stream_header = None
 
     def parse(self, filename, video):
+        self._parse_level = 0
+        self._last_stream_header = None
+        
         stream = streams.factory.create_filestream(filename,
                                                    endianess=self._endianess)
 
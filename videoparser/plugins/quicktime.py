@@ -115,6 +115,8 @@ class Parser(plugins.BaseParser):
         self._tkhd_subtype = None
         
     def parse(self, filename, video):
+        self._tkhd_subtype = None
+        
         stream = streams.factory.create_filestream(filename,
                                                    endianess=self._endianess)
 
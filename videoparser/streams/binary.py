@@ -29,6 +29,7 @@
 
 
 import datetime
+import uuid
 
 import struct
 import cStringIO
@@ -37,6 +38,35 @@ import cStringIO
 from videoparser.streams import endian
 
 
+# time_low, time_mid, time_hi, clock_seq_hi, clock_seq_low, node
+_guid_structs = {endian.little: struct.Struct('<IHHBB6s'),
+                 endian.big: struct.Struct('>IHHBB6s')}
+
+def format_guid(data, endianess=endian.little):
+    """ The string form of 16 guid bytes.  The clock_seq bytes are printed
+        without padding, as read_guid always did. """
+    # See http://www.ietf.org/rfc/rfc4122.txt for specification
+    time_low, time_mid, time_hi, clock_seq_hi, clock_seq_low, node = \
+        _guid_structs[endianess].unpack(data)
+    return "%08X-%04X-%04X-%X%X-%s" % (time_low, time_mid, time_hi,
+                                       clock_seq_hi, clock_seq_low,
+                                       node.encode('hex').upper())
+
+def guid_table(guid_list, endianess=endian.little):
+    """ Turn a {guid string: name} dict into {guid bytes: name}, to look up
+        read_guid_bytes() in one go.  Strings read_guid can't return are
+        left out, so lookups behave as they do by string. """
+    table = {}
+    for guid, name in guid_list.items():
+        if endianess == endian.big:
+            data = uuid.UUID(guid).bytes
+        else:
+            data = uuid.UUID(guid).bytes_le
+        if format_guid(data, endianess) == guid:
+            table[data] = name
+    return table
+
+
 class BinaryStream(object):
     
     def __init__(self, fileobj, filesize, endianess=endian.little):
@@ -56,6 +86,9 @@ class BinaryStream(object):
     def tell(self):
         return self._fileobj.tell()
     
+    def skip(self, length):
+        self.seek(self.tell() + length)
+    
     def seek(self, position):
         return self._fileobj.seek(position)
     
@@ -201,42 +234,17 @@ class BinaryStream(object):
         return value
 
     # ASF Specification requires the guid type, which is 128 bits aka 16 bytes
+    def read_guid_bytes(self):
+        """ Read a guid as its 16 raw bytes, see guid_table()."""
+        data = self.read(16)
+        if len(data) != 16:
+            raise AssertionError("Unexpected end of stream")
+        return data
+    
     def read_guid(self):
-        # See http://www.ietf.org/rfc/rfc4122.txt for specification
-        # The version number is in the most significant 4 bits of the time
-        # stamp (bits 4 through 7 of the time_hi_and_version field).
-        # Python 2.5 includes a built-in guid module, which should be used
-        
-        
-        # retrieve version        
-        position = self.tell()
-        self.seek(position + 6)
-        version = self.read_uint16() >> 12
-        self.seek(position)
-        
-        #print repr([hex(ord(x)) for x in self.read(16)])
-        
-        self.seek(position)
-        
-        time_low = self.read_uint32() 
-        time_mid = self.read_uint16()
-        time_hi  = self.read_uint16()
-        clock_seq_hi    = self.read_uint8()
-        clock_seq_low   = self.read_uint8()
-        node            = self.read(6)
-        
-        #print "uuid version = %d - %X" % (version, time_low)
-        if version == 1:
-            node = self.convert_uintvar(node, endian.big)
-        else:
-            node = self.convert_uintvar(node, endian.big)
-        
-        return "%08X-%04X-%04X-%X%X-%012X" % (time_low,
-                                            time_mid,
-                                            time_hi,
-                                            clock_seq_hi,
-                                            clock_seq_low,
-                                            node)
+        """ Read a guid as a string like
+            '75B22630-668E-11CF-A6D9-00AA0062CE6C'. """
+        return format_guid(self.read_guid_bytes(), self._endianess)
                                      
     def read_waveformatex(self):
         obj = self.WAVEFORMATEX()
@@ -248,7 +256,7 @@ class BinaryStream(object):
         obj.block_alignment = self.read_uint16()
         obj.bits_per_sample = self.read_uint16()
         obj.codec_size = self.read_uint16()
-        obj.codec_data = self.read_subsegment(obj.codec_size)
+        obj.codec_data = self.read(obj.codec_size)
         return obj
     
     def read_bitmapinfoheader(self):
@@ -265,13 +273,17 @@ class BinaryStream(object):
         obj.v_pixels_meter      = self.read_uint32()
         obj.colors              = self.read_uint32()
         obj.important_colors    = self.read_uint32()
-        obj.codec_data          = self.read_subsegment(obj.format_data_size -
-                                                       40)
+        obj.codec_data          = self.read(obj.format_data_size - 40)
         
         return obj
 
 
     class BITMAPINFOHEADER(object):
+        __slots__ = ['format_data_size', 'image_width', 'image_height',
+                     'reserved', 'bpp', 'compression_id', 'image_size',
+                     'h_pixels_meter', 'v_pixels_meter', 'colors',
+                     'important_colors', 'codec_data']
+        
         def __repr__(self):
             buffer  = "BITMAPINFOHEADER structure: \n"
             buffer += " %-35s : %s\n" % ("Format Data Size", self.format_data_size)
@@ -285,12 +297,16 @@ class BinaryStream(object):
             buffer += " %-35s : %s\n" % ("Vertical Pixels Per Meter", self.v_pixels_meter)
             buffer += " %-35s : %s\n" % ("Colors Used Count", self.colors)
             buffer += " %-35s : %s\n" % ("Important Colors Count", self.important_colors)
-            buffer += " %-35s : %s\n" % ("Codec Specific Data", self.codec_data)
+            buffer += " %-35s : %r\n" % ("Codec Specific Data", self.codec_data)
 
             return buffer
         
     # Used in ASF and AVI parser, contains audio information
     class WAVEFORMATEX(object):
+        __slots__ = ['codec_id', 'channels', 'sample_rate', 'bit_rate',
+                     'block_alignment', 'bits_per_sample', 'codec_size',
+                     'codec_data']
+        
         codec_ids = {
             0x2004:     "A_REAL/COOK",
             0x2003:     "A_REAL/28_8",
@@ -319,5 +335,116 @@ class BinaryStream(object):
             buffer += " %-35s : %s\n" % ("Codec Specific Data Size",self.codec_size)
             buffer += " %-35s : %s\n" % ("Codec Specific Data", repr(self.codec_data))
             
-            return buffer    
+            return buffer
 
+
+# Precompiled struct.Struct objects per endianess and format
+_structs = {endian.little: {}, endian.big: {}}
+
+def get_struct(endianess, type):
+    try:
+        return _structs[endianess][type]
+    except KeyError:
+        if endianess == endian.big:
+            s = struct.Struct('>' + type)
+        else:
+            s = struct.Struct('<' + type)
+        _structs[endianess][type] = s
+        return s
+
+# unpack_from of the fixed size integers, per endianess
+_unpackers = dict((e, tuple(get_struct(e, type).unpack_from
+                            for type in ('Q', 'I', 'H')))
+                  for e in (endian.little, endian.big))
+
+
+class BufferStream(BinaryStream):
+    """ BinaryStream over a string or mmap held in memory.
+    
+        Fields are unpacked in place with precompiled structs, and
+        subsegments are windows on the same buffer instead of copies (python
+        2 mmaps don't support memoryview, so the window is kept as offsets)."""
+    
+    def __init__(self, data, start=0, end=None, endianess=endian.little):
+        if end is None:
+            end = len(data)
+        self._data = data
+        self._start = start
+        self._pos = start
+        self._end = end
+        self._filesize = end - start
+        self._endianess = endianess
+        self._uint64, self._uint32, self._uint16 = _unpackers[endianess]
+        
+    def read(self, length):
+        if not length:
+            return ''
+        
+        pos = self._pos
+        end = max(pos, min(pos + length, self._end))
+        self._pos = end
+        return self._data[pos:end]
+    
+    def tell(self):
+        return self._pos - self._start
+    
+    def seek(self, position):
+        self._pos = self._start + position
+    
+    def close(self):
+        # an mmap is unmapped once no subsegment refers to it either
+        self._data = None
+    
+    def bytes_left(self):
+        return self._pos < self._end
+    
+    def set_endianess(self, endianess):
+        self._endianess = endianess
+        self._uint64, self._uint32, self._uint16 = _unpackers[endianess]
+    
+    def unpack(self, type, length):
+        s = get_struct(self._endianess, type)
+        pos = self._pos
+        end = pos + s.size
+        if end > self._end:
+            raise AssertionError("Unexpected end of stream")
+        self._pos = end
+        return s.unpack_from(self._data, pos)[0]
+    
+    # The fixed size readers are spelled out, they are most of the work
+    def read_uint64(self):
+        pos = self._pos
+        if pos + 8 > self._end:
+            raise AssertionError("Unexpected end of stream")
+        self._pos = pos + 8
+        return self._uint64(self._data, pos)[0]
+    
+    def read_int64(self):
+        return self.unpack('q', 8)
+    
+    def read_uint32(self):
+        pos = self._pos
+        if pos + 4 > self._end:
+            raise AssertionError("Unexpected end of stream")
+        self._pos = pos + 4
+        return self._uint32(self._data, pos)[0]
+    
+    def read_uint16(self):
+        pos = self._pos
+        if pos + 2 > self._end:
+            raise AssertionError("Unexpected end of stream")
+        self._pos = pos + 2
+        return self._uint16(self._data, pos)[0]
+    
+    def read_uint8(self):
+        pos = self._pos
+        if pos >= self._end:
+            raise AssertionError("Unexpected end of stream")
+        self._pos = pos + 1
+        return ord(self._data[pos])
+    
+    def read_subsegment(self, length):
+        start = self._pos
+        end = max(start, min(start + length, self._end))
+        self._pos = end
+        return BufferStream(self._data, start, end, self._endianess)
\ No newline at end of file
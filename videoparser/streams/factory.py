@@ -24,8 +24,12 @@
 
 import os
 import stat
+import mmap
 
-from videoparser.streams.binary import BinaryStream
+from videoparser.streams.binary import BinaryStream, BufferStream
+
+# Map files into memory where possible instead of reading field by field
+use_mmap = True
 
 def create_filestream(filename, endianess):
     filesize = os.stat(filename)[stat.ST_SIZE]
@@ -33,11 +37,19 @@ def create_filestream(filename, endianess):
     if filesize == 0:
         raise IOError("File %s is 0 bytes!" % filename)
     fh = open(filename, 'rb')
+    if use_mmap:
+        try:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, OverflowError, ValueError):
+            # e.g. no address space left for a huge file on 32 bit
+            pass
+        else:
+            fh.close()
+            return BufferStream(data, 0, filesize, endianess)
     stream = BinaryStream(fh, filesize, endianess)
     return stream
 
 
 def create_stringstream(data, endianess):
-    fh = cStringIO.StringIO(data)
-    stream = BinaryStream(fh, len(data), endianess)
+    stream = BufferStream(data, 0, len(data), endianess)
     return stream
\ No newline at end of file
@@ -87,6 +87,9 @@ class VideoFile(object):
 
 class VideoStream(object):
     """ Contains information from a video stream."""
+    __slots__ = ['_duration', '_framerate', '_codec', 'type', '_width',
+                 '_height', '_codec_name', '_codec_description']
+    
     def __init__(self):
         self._duration = 0
         self._framerate = 0
@@ -141,6 +144,9 @@ class VideoStream(object):
     
 class AudioStream(object):
     """ Contains information from a audio stream."""
+    __slots__ = ['_channels', '_codec', '_sample_rate', '_duration',
+                 '_bitrate', '_bits_per_sample', 'type']
+    
     def __init__(self):
         self._channels = 0
         self._codec = ''
@@ -3,6 +3,7 @@ import sys
 
 import videoparser
 import videoparser.plugins.asf
+import videoparser.streams.factory
 
 ASFParser = videoparser.plugins.asf.Parser
 def hack_extract_information(self, header, video):
@@ -15,13 +16,44 @@ VERIFIED_RESULT_OK = 'ok'
 VERIFIED_RESULT_BADSIZE = 'bad size'
 VERIFIED_RESULT_ZERO_DURATION = 'zero duration'
 
+# the header objects header_metadata looks at, the rest is skipped
+METADATA_OBJECTS = frozenset([
+    'ASF_File_Properties_Object',
+    'ASF_Stream_Properties_Object',
+    'ASF_Header_Extension_Object',
+    'ASF_Extended_Stream_Properties_Object',
+    ])
+
+asf_parser = ASFParser()
+
 def extract_metadata(fn):
     #print fn
-    video_parser = videoparser.VideoParser()
-    video = video_parser.parse_file(fn)
-    if not video:
+    try:
+        stream = videoparser.streams.factory.create_filestream(fn,
+                ASFParser._endianess)
+    except EnvironmentError:
+        return None
+    return stream_metadata(stream)
+
+def extract_metadata_from_header(data):
+    """Like extract_metadata, but from the ASF header object at the start of
+    a file, given as a string."""
+    stream = videoparser.streams.factory.create_stringstream(data,
+            ASFParser._endianess)
+    return stream_metadata(stream)
+
+def stream_metadata(stream):
+    try:
+        if videoparser.plugins.asf.guid_table.get(stream.read_guid_bytes()) != 'ASF_Header_Object':
+            return None
+        h = asf_parser.parse_header(stream, METADATA_OBJECTS)
+    except AssertionError:
         return None
-    h = video.header
+    finally:
+        stream.close()
+    return header_metadata(h)
+
+def header_metadata(h):
     d = {}
 
     #print h